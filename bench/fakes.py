@@ -0,0 +1,192 @@
+import time
+import random
+import asyncio
+import argparse
+import threading
+from collections import defaultdict
+from types import SimpleNamespace
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from bench.stats import LatencyRecorder
+
+
+# Auth Service roles by id: students below the offset, bus drivers ("chauffeur") above it
+BUS_ID_OFFSET = 1_000_000
+# Parent of student N in the fake student service
+PARENT_ID_OFFSET = 2_000_000
+
+
+# Data keys the Kafka harness puts in each message; the fake FCM reads them to measure end-to-end latency
+BENCH_RUN_KEY = "bench_run"
+BENCH_SENT_AT_KEY = "bench_sent_at"
+
+
+def create_fake_services(latency_ms: float = 0.0, error_rate: float = 0.0) -> FastAPI:
+    """Auth Service and Student Service stand-in answering every call the services make.
+
+    A fraction ``error_rate`` of the calls fails with 503, which the worker
+    treats as transient and sends to its retry tiers.
+    """
+    app = FastAPI(title="Fake Auth/Student Service")
+
+    async def delay():
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0)
+        if error_rate and random.random() < error_rate:
+            raise HTTPException(status_code=503, detail="Injected failure")
+
+    @app.post("/auth/login")
+    async def login():
+        await delay()
+        return {"accessToken": "fake-admin-token"}
+
+    @app.get("/auth/user/{user_id}")
+    async def get_user(user_id: int):
+        await delay()
+        if user_id <= 0:
+            raise HTTPException(status_code=404, detail="User not found")
+        return {"id": user_id, "role": "chauffeur" if user_id >= BUS_ID_OFFSET else "student"}
+
+    @app.get("/auth/users/{user_id}/device_token")
+    async def get_device_token(user_id: str):
+        await delay()
+        return {"device_token": f"fake-device-{user_id}"}
+
+    @app.get("/students/{student_id}")
+    async def get_student(student_id: int):
+        await delay()
+        return {"id": student_id, "parent_id": PARENT_ID_OFFSET + student_id}
+
+    return app
+
+
+def fcm_error(status_code: int, status: str, message: str, fcm_code: str = None) -> JSONResponse:
+    """An error body in the FCM v1 format, which the Admin SDK maps to its exception types"""
+    error = {"code": status_code, "message": message, "status": status}
+    if fcm_code:
+        error["details"] = [{"@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError", "errorCode": fcm_code}]
+    return JSONResponse(status_code=status_code, content={"error": error})
+
+
+def create_fake_fcm(latency_ms: float = 0.0, error_rate: float = 0.0, unavailable_rate: float = 0.0) -> FastAPI:
+    """FCM HTTP v1 endpoint the Firebase Admin SDK can be pointed at (worker setting FCM_ENDPOINT).
+
+    ``error_rate`` of the sends fail permanently (UNREGISTERED token) and
+    ``unavailable_rate`` transiently (503 UNAVAILABLE, retried by the SDK and
+    then by the worker). Messages carrying the harness' ``bench_run`` and
+    ``bench_sent_at`` data keys are counted per run, with their latency from
+    the producer to this "device"; GET /stats/{run} returns the summary.
+    """
+    app = FastAPI(title="Fake FCM")
+    app.state.delivered = defaultdict(LatencyRecorder)
+    app.state.counts = defaultdict(lambda: {"received": 0, "failed": 0, "unavailable": 0,
+                                            "first_delivery_at": None, "last_delivery_at": None})
+
+    @app.post("/v1/projects/{project_id}/messages:send")
+    async def send(project_id: str, request: Request):
+        body = await request.json()
+        message = body.get("message", {})
+        data = message.get("data") or {}
+        run = data.get(BENCH_RUN_KEY, "")
+        counts = app.state.counts[run]
+        counts["received"] += 1
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0)
+
+        roll = random.random()
+        if roll < unavailable_rate:
+            counts["unavailable"] += 1
+            return fcm_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+        if roll < unavailable_rate + error_rate:
+            counts["failed"] += 1
+            return fcm_error(404, "NOT_FOUND", "Requested entity was not found.", fcm_code="UNREGISTERED")
+
+        now = time.time()
+        counts["first_delivery_at"] = counts["first_delivery_at"] or now
+        counts["last_delivery_at"] = now
+        if BENCH_SENT_AT_KEY in data:
+            app.state.delivered[run].observe("delivery", now - float(data[BENCH_SENT_AT_KEY]))
+        return {"name": f"projects/{project_id}/messages/{random.getrandbits(63)}"}
+
+    @app.get("/stats/{run}")
+    async def stats(run: str):
+        recorder = app.state.delivered[run]
+        return {**app.state.counts[run], "delivered": len(recorder.samples.get("delivery", [])),
+                "latency": recorder.summary(1.0).get("delivery", {})}
+
+    return app
+
+
+def serve_in_thread(app: FastAPI, port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """Run an ASGI app in a daemon thread; returns once it accepts connections"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name=f"fake-{port}", daemon=True)
+    thread.start()
+
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Fake service did not start on port {port}")
+        time.sleep(0.05)
+    return server
+
+
+def install_fake_firebase(latency_ms: float = 0.0, error_rate: float = 0.0):
+    """Replace the Firebase Admin SDK send functions with in-process fakes.
+
+    ``send`` sleeps ``latency_ms`` per message, ``send_each_for_multicast`` once
+    per call, like one HTTP round trip each; a fraction ``error_rate`` of the
+    tokens fails like an unregistered token (NOT_FOUND).
+    """
+    from firebase_admin import messaging
+
+    def failure():
+        return messaging.UnregisteredError("Requested entity was not found.")
+
+    def send(message, dry_run=False, app=None):
+        time.sleep(latency_ms / 1000.0)
+        if error_rate and random.random() < error_rate:
+            raise failure()
+        return f"projects/fake/messages/{random.getrandbits(63)}"
+
+    def send_each_for_multicast(multicast_message, dry_run=False, app=None):
+        time.sleep(latency_ms / 1000.0)
+        responses = []
+        for _ in multicast_message.tokens:
+            if error_rate and random.random() < error_rate:
+                responses.append(SimpleNamespace(success=False, exception=failure(), message_id=None))
+            else:
+                responses.append(SimpleNamespace(success=True, exception=None, message_id=f"projects/fake/messages/{random.getrandbits(63)}"))
+        return SimpleNamespace(
+            responses=responses,
+            success_count=sum(r.success for r in responses),
+            failure_count=sum(not r.success for r in responses),
+        )
+
+    messaging.send = send
+    messaging.send_each_for_multicast = send_each_for_multicast
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Auth/Student services or FCM")
+    parser.add_argument("service", choices=["auth", "fcm"])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None, help="Default 9400 (auth) / 9500 (fcm)")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of permanent failures (fcm) or 503s (auth)")
+    parser.add_argument("--unavailable-rate", type=float, default=0.0, help="fcm only: fraction of 503 UNAVAILABLE")
+    args = parser.parse_args()
+
+    if args.service == "auth":
+        app = create_fake_services(latency_ms=args.latency_ms, error_rate=args.error_rate)
+    else:
+        app = create_fake_fcm(latency_ms=args.latency_ms, error_rate=args.error_rate, unavailable_rate=args.unavailable_rate)
+    uvicorn.run(app, host=args.host, port=args.port or (9400 if args.service == "auth" else 9500), log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Push N notifications through Kafka and measure what reaches the fake FCM endpoint.
+
+Start the fakes and a worker pointed at them first, for example:
+
+    python -m bench.fakes auth --port 9400 --latency-ms 5 &
+    python -m bench.fakes fcm --port 9500 --latency-ms 20 --error-rate 0.01 &
+    cd notification_service && FCM_ENDPOINT=http://127.0.0.1:9500 \\
+        AUTH_SERVICE_URL=http://127.0.0.1:9400 STUDENT_SERVICE_URL=http://127.0.0.1:9400 \\
+        python worker/consumer.py &
+    python -m bench.kafka_harness --messages 10000
+
+Delivery rate is counted from the first produced message to the last push
+received by the fake FCM; latency is producer -> fake FCM, per message.
+"""
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+
+import httpx
+from kafka import KafkaProducer
+
+from bench.fakes import BENCH_RUN_KEY, BENCH_SENT_AT_KEY
+
+
+logger = logging.getLogger(__name__)
+
+
+def produce(producer: KafkaProducer, topic: str, run: str, messages: int, rate: float, notification_type: str,
+            first_student_id: int) -> float:
+    """Send ``messages`` notifications (at most ``rate`` per second if set); returns when the first was sent"""
+    started = time.time()
+    for i in range(messages):
+        if rate:
+            ahead = started + i / rate - time.time()
+            if ahead > 0:
+                time.sleep(ahead)
+
+        producer.send(topic, {
+            "student_id": first_student_id + i,
+            "notification_type": notification_type,
+            "eta": 5,
+            "title": "Load test",
+            "body": f"Message {i}",
+            "idempotency_key": f"bench-{run}-{i}",
+            "data": {BENCH_RUN_KEY: run, BENCH_SENT_AT_KEY: repr(time.time())},
+        })
+    producer.flush()
+    return started
+
+
+def wait_for_deliveries(fcm_url: str, run: str, expected: int, timeout: float, idle_timeout: float) -> dict:
+    """Poll the fake FCM until every message is delivered or failed, or progress stops"""
+    deadline = time.monotonic() + timeout
+    last_progress, last_seen = time.monotonic(), -1
+
+    while True:
+        stats = httpx.get(f"{fcm_url}/stats/{run}", timeout=5).json()
+        done = stats["delivered"] + stats["failed"]
+        if done >= expected:
+            return stats
+
+        now = time.monotonic()
+        if done != last_seen:
+            last_progress, last_seen = now, done
+        if now > deadline or now - last_progress > idle_timeout:
+            logger.warning(f"Stopped waiting with {done}/{expected} messages accounted for")
+            return stats
+        time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end worker throughput through Kafka and a fake FCM")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=0, help="Messages per second to produce (0 = as fast as possible)")
+    parser.add_argument("--bootstrap", default="localhost:9092")
+    parser.add_argument("--topic", default="eta_notifications")
+    parser.add_argument("--fcm-url", default="http://127.0.0.1:9500")
+    parser.add_argument("--notification-type", default="eta_update",
+                        help="eta_update is held for NOTIFICATION_COALESCE_WINDOW_SECONDS by the worker; set it to 0 for raw throughput")
+    parser.add_argument("--first-student-id", type=int, default=1, help="Each message goes to its own student from here on")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--idle-timeout", type=float, default=60, help="Give up after this long without a new delivery")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run = uuid.uuid4().hex[:12]
+    producer = KafkaProducer(
+        bootstrap_servers=args.bootstrap.split(","),
+        value_serializer=lambda v: json.dumps(v).encode("utf-8"),
+        linger_ms=5,
+    )
+
+    started = produce(producer, args.topic, run, args.messages, args.rate, args.notification_type, args.first_student_id)
+    produced_in = time.time() - started
+    producer.close()
+    print(f"Run {run}: produced {args.messages} messages in {produced_in:.1f}s ({args.messages / produced_in:.0f}/s)")
+
+    stats = wait_for_deliveries(args.fcm_url, run, args.messages, args.timeout, args.idle_timeout)
+    latency = stats["latency"]
+    elapsed = (stats["last_delivery_at"] or time.time()) - started
+
+    print(f"Delivered {stats['delivered']}/{args.messages}, failed {stats['failed']}, "
+          f"transient FCM errors {stats['unavailable']}, FCM requests {stats['received']}")
+    if stats["delivered"]:
+        print(f"Delivery rate {stats['delivered'] / elapsed:.0f}/s over {elapsed:.1f}s")
+        print(f"Producer -> FCM latency: p50 {latency['p50_ms']:.0f} ms, p95 {latency['p95_ms']:.0f} ms, "
+              f"p99 {latency['p99_ms']:.0f} ms, max {latency['max_ms']:.0f} ms")
+
+    return 0 if stats["delivered"] + stats["failed"] >= args.messages else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
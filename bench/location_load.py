@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import subprocess
+
+import httpx
+
+from bench.fakes import BUS_ID_OFFSET
+from bench.stats import LatencyRecorder
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Around Algiers; buses drift a little on every report
+ORIGIN = (36.7538, 3.0588)
+
+CREATE_LOCATION = "POST /locations/{entity_type}/{entity_id}"
+LATEST_LOCATIONS = "GET /entities/locations"
+ENTITY_HISTORY = "GET /locations/entity/{entity_type}/{entity_id}"
+
+
+def start_location_service(database_url: str, auth_base_url: str, port: int) -> subprocess.Popen:
+    """Run the real location service (uvicorn) against the benchmark database and fake Auth Service"""
+    env = dict(os.environ, DATABASE_URL=database_url, AUTH_BASE_URL=auth_base_url)
+    cwd = os.path.join(ROOT, "location_service")
+    subprocess.run([sys.executable, "-m", "app.migrate"], cwd=cwd, env=env, check=True)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd,
+        env=env,
+    )
+
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("Location service did not start")
+        time.sleep(0.2)
+
+
+async def timed_request(client: httpx.AsyncClient, recorder: LatencyRecorder, name: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    response = None
+    try:
+        response = await client.request(method, url, **kwargs)
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        ok = False
+
+    if ok:
+        recorder.observe(name, time.perf_counter() - started)
+    else:
+        recorder.error(name)
+    return response
+
+
+async def reporter(client, recorder, entity_type: str, entity_id: int, interval: float, stop_at: float):
+    """One GPS device reporting every ``interval`` seconds"""
+    lat, lon = ORIGIN[0] + random.uniform(-0.05, 0.05), ORIGIN[1] + random.uniform(-0.05, 0.05)
+    await asyncio.sleep(random.uniform(0, interval))
+
+    while time.monotonic() < stop_at:
+        lat += random.uniform(-0.0005, 0.0005)
+        lon += random.uniform(-0.0005, 0.0005)
+        await timed_request(client, recorder, CREATE_LOCATION, "POST", f"/locations/{entity_type}/{entity_id}",
+                            params={"latitude": lat, "longitude": lon})
+        await asyncio.sleep(interval)
+
+
+async def dashboard(client, recorder, bus_ids, interval: float, stop_at: float):
+    """A dispatcher screen: the fleet map every ``interval`` seconds (revalidated with its ETag), a bus trail now and then"""
+    await asyncio.sleep(random.uniform(0, interval))
+    etag = None
+
+    while time.monotonic() < stop_at:
+        response = await timed_request(client, recorder, LATEST_LOCATIONS, "GET", "/entities/locations",
+                                       params={"entity_type": "bus"}, headers={"If-None-Match": etag} if etag else None)
+        if response is not None and response.status_code in (200, 304):
+            etag = response.headers.get("etag", etag)
+        if random.random() < 0.2:
+            await timed_request(client, recorder, ENTITY_HISTORY, "GET", f"/locations/entity/bus/{random.choice(bus_ids)}",
+                                params={"limit": 50})
+        await asyncio.sleep(interval)
+
+
+async def run_location_load(base_url: str, duration: float, buses: int, students: int, dashboards: int,
+                            bus_interval: float = 2.0, student_interval: float = 10.0,
+                            dashboard_interval: float = 1.0) -> dict:
+    """Closed-loop load: every bus, student device and dashboard is one virtual client"""
+    recorder = LatencyRecorder()
+    bus_ids = [BUS_ID_OFFSET + i for i in range(1, buses + 1)]
+    student_ids = list(range(1, students + 1))
+
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        started = time.monotonic()
+        stop_at = started + duration
+        tasks = [reporter(client, recorder, "bus", i, bus_interval, stop_at) for i in bus_ids]
+        tasks += [reporter(client, recorder, "student", i, student_interval, stop_at) for i in student_ids]
+        tasks += [dashboard(client, recorder, bus_ids, dashboard_interval, stop_at) for _ in range(dashboards)]
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+
+    return recorder.summary(elapsed)
@@ -0,0 +1,92 @@
+"""Benchmark both services against local fakes and compare with the stored baseline.
+
+    python -m bench.run                      # both suites, compare with bench/baseline.json
+    python -m bench.run --only worker --save-baseline
+
+PostGIS comes from BENCH_DATABASE_URL or a throwaway Docker container; the
+Auth/Student services and Firebase are local fakes, so no network is needed.
+Exits with status 1 when a result regresses past the tolerance.
+"""
+import os
+import sys
+import asyncio
+import logging
+import argparse
+
+from bench import postgis
+from bench.fakes import create_fake_services, serve_in_thread
+from bench.location_load import run_location_load, start_location_service
+from bench.stats import compare, format_report, load_baseline, save_baseline
+
+
+logger = logging.getLogger(__name__)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and benchmark suite for the location and notification services")
+    parser.add_argument("--only", choices=["location", "worker"], help="Run a single suite")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of location-service load")
+    parser.add_argument("--buses", type=int, default=50)
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--dashboards", type=int, default=5)
+    parser.add_argument("--eta-bursts", type=int, default=3, help="ETA bursts pushed through the worker")
+    parser.add_argument("--fake-latency-ms", type=float, default=5, help="Latency of the fake Auth/Student service")
+    parser.add_argument("--fcm-latency-ms", type=float, default=20, help="Latency of the fake Firebase send")
+    parser.add_argument("--fake-port", type=int, default=9400)
+    parser.add_argument("--location-port", type=int, default=9401)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    database_url = postgis.start_postgis()
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    serve_in_thread(create_fake_services(latency_ms=args.fake_latency_ms), args.fake_port)
+
+    results = {}
+    try:
+        if args.only in (None, "location"):
+            service = start_location_service(database_url, f"{fake_url}/auth/", args.location_port)
+            try:
+                results["location"] = asyncio.run(run_location_load(
+                    f"http://127.0.0.1:{args.location_port}", args.duration, args.buses, args.students, args.dashboards
+                ))
+            finally:
+                service.terminate()
+                service.wait()
+
+        if args.only in (None, "worker"):
+            # Imported here: it puts notification_service's ``app`` package on the path
+            from bench.worker_load import run_worker_load
+            results["worker"] = run_worker_load(
+                database_url, fake_url, students=args.students, bursts=args.eta_bursts,
+                fcm_latency_ms=args.fcm_latency_ms
+            )
+    finally:
+        postgis.stop_postgis()
+
+    print(format_report(results))
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if not baseline:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+
+    regressions = compare(results, baseline, tolerance=args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
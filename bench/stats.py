@@ -0,0 +1,104 @@
+import json
+import math
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1))]
+
+
+class LatencyRecorder:
+    """Raw latency samples per name (endpoint or pipeline stage), plus error counts"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors = Counter()
+
+    def observe(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+    def error(self, name: str):
+        self.errors[name] += 1
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def summary(self, duration: float) -> Dict[str, dict]:
+        """count, errors, throughput (per second over ``duration``) and p50/p95/p99/max in milliseconds"""
+        results = {}
+        for name in sorted(set(self.samples) | set(self.errors)):
+            ordered = sorted(self.samples[name])
+            results[name] = {
+                "count": len(ordered),
+                "errors": self.errors[name],
+                "throughput": len(ordered) / duration if duration > 0 else 0.0,
+                "p50_ms": percentile(ordered, 50) * 1000,
+                "p95_ms": percentile(ordered, 95) * 1000,
+                "p99_ms": percentile(ordered, 99) * 1000,
+                "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+            }
+        return results
+
+
+def format_report(results: Dict[str, Dict[str, dict]]) -> str:
+    lines = []
+    for suite, rows in results.items():
+        lines.append(f"== {suite} ==")
+        lines.append(f"{'name':<48} {'count':>8} {'err':>5} {'per s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for name, row in rows.items():
+            lines.append(
+                f"{name:<48} {row['count']:>8} {row['errors']:>5} {row['throughput']:>9.1f} "
+                f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}"
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def load_baseline(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path: str, results: dict):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.25, min_delta_ms: float = 2.0) -> List[str]:
+    """Regressions against the baseline: p95/p99 up or throughput down by more than ``tolerance``.
+
+    Latency changes smaller than ``min_delta_ms`` are ignored, they are noise
+    for sub-millisecond stages.
+    """
+    regressions = []
+    for suite, rows in baseline.items():
+        for name, base in rows.items():
+            current = results.get(suite, {}).get(name)
+            if current is None:
+                continue
+
+            for key in ("p95_ms", "p99_ms"):
+                if current[key] > base[key] * (1 + tolerance) and current[key] - base[key] > min_delta_ms:
+                    regressions.append(f"{suite} / {name}: {key} {base[key]:.1f} -> {current[key]:.1f}")
+
+            if base["throughput"] and current["throughput"] < base["throughput"] * (1 - tolerance):
+                regressions.append(f"{suite} / {name}: throughput {base['throughput']:.1f} -> {current['throughput']:.1f}/s")
+
+            if current["errors"] > base["errors"]:
+                regressions.append(f"{suite} / {name}: errors {base['errors']} -> {current['errors']}")
+    return regressions
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from kafka.structs import TopicPartition
+
+from bench.fakes import install_fake_firebase
+from bench.stats import LatencyRecorder
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ETA_TOPIC = "eta_notifications"
+URGENT_TOPIC = "urgent_notifications"
+PARTITIONS = 6
+
+
+class FakeConsumer:
+    """The KafkaConsumer calls the worker's scheduling loop makes, over in-memory records"""
+
+    def __init__(self, partitions):
+        self.partitions = set(partitions)
+        self.positions = {tp: 0 for tp in self.partitions}
+        self.highwaters = {tp: 0 for tp in self.partitions}
+        self.committed = {}
+        self.paused = set()
+
+    def assignment(self):
+        return self.partitions
+
+    def position(self, tp):
+        return self.positions[tp]
+
+    def highwater(self, tp):
+        return self.highwaters[tp]
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    def pause(self, *tps):
+        self.paused.update(tps)
+
+    def resume(self, *tps):
+        self.paused.difference_update(tps)
+
+    def commit(self, offsets=None):
+        self.committed.update({tp: meta.offset for tp, meta in (offsets or {}).items()})
+
+
+class NullProducer:
+    """Stands in for the retry producer; nothing should be retried against the fakes"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, value=None, **kwargs):
+        self.sent.append((topic, value))
+
+    def flush(self, timeout=None):
+        pass
+
+
+class RecordingStage:
+    """Replaces a worker stage histogram so the benchmark sees every raw sample"""
+
+    def __init__(self, recorder: LatencyRecorder, name: str):
+        self.recorder = recorder
+        self.name = name
+
+    def observe(self, seconds: float):
+        self.recorder.observe(self.name, seconds)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+def build_records(consumer: FakeConsumer, students: int, bursts: int, updates_per_burst: int, urgent_ratio: float):
+    """ETA bursts: every student gets a few updates per burst (coalesced), plus some urgent alerts"""
+    run_id = uuid.uuid4().hex[:8]
+    batches = {}
+    sequence = 0
+
+    for _ in range(bursts * updates_per_burst):
+        for student_id in range(1, students + 1):
+            urgent = random.random() < urgent_ratio
+            topic = URGENT_TOPIC if urgent else ETA_TOPIC
+            tp = TopicPartition(topic, student_id % PARTITIONS)
+            value = {
+                "student_id": student_id,
+                "notification_type": "bus_incident" if urgent else "eta_update",
+                "eta": random.randint(1, 30),
+                "idempotency_key": f"bench-{run_id}-{sequence}",
+            }
+            if urgent:
+                value.update(title="Bus incident", body="Your child's bus is delayed.")
+
+            offset = consumer.highwaters.setdefault(tp, 0)
+            consumer.highwaters[tp] = offset + 1
+            consumer.positions[tp] = offset + 1
+            consumer.partitions.add(tp)
+            batches.setdefault(tp, []).append(SimpleNamespace(
+                topic=topic, partition=tp.partition, offset=offset,
+                value=json.dumps(value).encode("utf-8"), headers=[],
+                timestamp=int(time.time() * 1000),
+            ))
+            sequence += 1
+
+    return batches, sequence
+
+
+def run_worker_load(database_url: str, fake_url: str, students: int = 500, bursts: int = 3,
+                    updates_per_burst: int = 3, urgent_ratio: float = 0.02, fcm_latency_ms: float = 20.0,
+                    coalesce_window: float = 0.5) -> dict:
+    """Drive the worker's real pipeline (decode -> lanes -> delivery -> history) without Kafka.
+
+    The services are the local fakes and Firebase is patched in-process, so the
+    numbers cover the worker itself and its database writes.
+    """
+    os.environ.update(DATABASE_URL=database_url, STUDENT_SERVICE_URL=fake_url, AUTH_SERVICE_URL=fake_url)
+    sys.path.insert(0, os.path.join(ROOT, "notification_service"))
+
+    from app.database import engine
+    from app.migrate import migrate
+    from worker import consumer as worker, metrics
+    from worker.coalescer import Coalescer, RateLimiter
+    from worker.dedup import DedupStore
+    from worker.history_buffer import HistoryBuffer
+    from worker.lanes import LaneScheduler
+    from worker.retry import RetryScheduler
+
+    migrate(engine)
+    install_fake_firebase(latency_ms=fcm_latency_ms)
+
+    recorder = LatencyRecorder()
+    for stage in metrics.STAGES:
+        metrics._stage_timers[stage] = RecordingStage(recorder, f"stage {stage}")
+
+    consumer = FakeConsumer([])
+    batches, total = build_records(consumer, students, bursts, updates_per_burst, urgent_ratio)
+    ctx = worker.WorkerContext(
+        history=HistoryBuffer(),
+        retries=RetryScheduler(NullProducer(), base_topic=ETA_TOPIC),
+        dedup=DedupStore(),
+        coalescer=Coalescer(window=coalesce_window),
+        rate_limiter=RateLimiter(),
+        lanes=LaneScheduler(),
+    )
+
+    started = time.monotonic()
+    worker.enqueue_batches(batches, ctx)
+    while ctx.lanes or ctx.coalescer:
+        with recorder.timer("round"):
+            worker.process_round(consumer, ctx.lanes.next_round(), ctx)
+        if not ctx.lanes and ctx.coalescer:
+            time.sleep(0.01)
+    elapsed = time.monotonic() - started
+
+    results = recorder.summary(elapsed)
+    results["messages"] = {
+        "count": total, "errors": len(ctx.retries.producer.sent), "throughput": total / elapsed,
+        "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0,
+    }
+    for lane, stats in ctx.lanes.latency.items():
+        if stats.count:
+            results[f"end-to-end {lane}"] = {
+                "count": stats.count, "errors": 0, "throughput": stats.count / elapsed,
+                "p50_ms": stats.percentile(50) * 1000, "p95_ms": stats.percentile(95) * 1000,
+                "p99_ms": stats.percentile(99) * 1000, "max_ms": stats.max * 1000,
+            }
+    return results
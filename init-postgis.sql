@@ -16,14 +16,18 @@ CREATE INDEX IF NOT EXISTS idx_locations_entity_id ON locations(entity_id);
 -- Create index on coordinates for geospatial queries
 CREATE INDEX IF NOT EXISTS idx_locations_coordinates ON locations USING GIST(coordinates);
 
--- Create table for notification history
+-- Create table for notification history, range-partitioned by month on timestamp
+-- (monthly partitions are created and archived by notification_service/app/partitions.py)
 CREATE TABLE IF NOT EXISTS notification_history (
-    id SERIAL PRIMARY KEY,
+    id SERIAL NOT NULL,
     user_id VARCHAR(255) NOT NULL,
     message TEXT NOT NULL,
     status VARCHAR(50) NOT NULL, -- 'sent', 'failed', 'pending'
-    timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS notification_history_default PARTITION OF notification_history DEFAULT;
 
 -- Create index on user_id for faster notification history queries
 CREATE INDEX IF NOT EXISTS idx_notification_history_user_id ON notification_history(user_id);
\ No newline at end of file
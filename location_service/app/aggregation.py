@@ -0,0 +1,188 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from sqlalchemy import text
+
+from app import archive, sharding
+from app.upload import LOCATION_UPLOAD_MAX_AGE_SECONDS
+
+
+# Grid cells per web-map tile side at a given zoom: zoom 14 gives cells of about 75 m
+GRID_CELLS_PER_TILE = int(os.getenv("GRID_CELLS_PER_TILE", "32"))
+# Requests covering more cells than this must zoom in or shrink the bounding box
+GRID_MAX_CELLS = int(os.getenv("GRID_MAX_CELLS", "250000"))
+# Below this speed (m/s) the time between two fixes counts as dwell time in the cell
+GRID_DWELL_SPEED_MPS = float(os.getenv("GRID_DWELL_SPEED_MPS", "1.0"))
+# Gaps between fixes longer than this (device off, bus parked overnight) count towards neither speed nor dwell
+GRID_MAX_GAP_SECONDS = int(os.getenv("GRID_MAX_GAP_SECONDS", "300"))
+# Time ranges are widened to whole buckets so nearby requests share a cache entry
+GRID_TIME_BUCKET_SECONDS = int(os.getenv("GRID_TIME_BUCKET_SECONDS", "3600"))
+# Results for ranges still receiving fixes expire after this; ranges fully in the past are kept until evicted.
+# Devices upload fixes up to LOCATION_UPLOAD_MAX_AGE_SECONDS late, so ranges count as past only after that
+GRID_CACHE_TTL_SECONDS = int(os.getenv("GRID_CACHE_TTL_SECONDS", "60"))
+GRID_CACHE_MAX_ENTRIES = int(os.getenv("GRID_CACHE_MAX_ENTRIES", "256"))
+
+_cache_lock = threading.Lock()
+_cache = OrderedDict()  # key -> (expires_at, result)
+
+
+# Each fix with its predecessor from the same entity, then speed and dwell credited to the fix's cell.
+# Predecessors are taken before the bbox filter, so leaving the box and coming back is not one step;
+# only entities with a fix in the box are scanned
+GRID_SQL = """
+WITH tracked AS (
+    SELECT entity_type, entity_id, coordinates, timestamp,
+           LAG(coordinates) OVER w AS prev_coordinates,
+           LAG(timestamp) OVER w AS prev_timestamp
+    FROM locations
+    WHERE timestamp >= :start AND timestamp < :end
+      AND (entity_type, entity_id) IN (
+          SELECT DISTINCT entity_type, entity_id FROM locations
+          WHERE timestamp >= :start AND timestamp < :end
+            AND coordinates && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+            {entity_filter}
+      )
+    WINDOW w AS (PARTITION BY entity_type, entity_id ORDER BY timestamp)
+), fixes AS (
+    SELECT * FROM tracked
+    WHERE coordinates && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+), steps AS (
+    SELECT ST_SnapToGrid(coordinates, :cell_size) AS cell,
+           entity_type || ':' || entity_id AS entity,
+           EXTRACT(EPOCH FROM timestamp - prev_timestamp) AS seconds,
+           ST_DistanceSphere(prev_coordinates, coordinates) AS meters
+    FROM fixes
+)
+SELECT ST_X(cell) AS longitude, ST_Y(cell) AS latitude,
+       COUNT(*) AS count,
+       COUNT(DISTINCT entity) AS entities,
+       AVG(meters / seconds) FILTER (WHERE seconds > 0 AND seconds <= :max_gap) AS mean_speed_mps,
+       COUNT(*) FILTER (WHERE seconds > 0 AND seconds <= :max_gap) AS speed_samples,
+       COALESCE(SUM(seconds) FILTER (WHERE seconds > 0 AND seconds <= :max_gap
+                                     AND meters / seconds < :dwell_speed), 0) AS dwell_seconds
+FROM steps
+GROUP BY cell
+"""
+
+
+class ArchivedRangeError(ValueError):
+    """The time range reaches into days moved to the archive, which the grid query cannot see"""
+
+
+def cell_size_degrees(zoom: int) -> float:
+    return 360.0 / (2 ** zoom) / GRID_CELLS_PER_TILE
+
+
+def snap_bbox(min_lon: float, min_lat: float, max_lon: float, max_lat: float, cell_size: float) -> Tuple[float, ...]:
+    """Widen the box to whole cells, so panning maps hit the same cache entries"""
+    return (
+        math.floor(min_lon / cell_size) * cell_size,
+        math.floor(min_lat / cell_size) * cell_size,
+        math.ceil(max_lon / cell_size) * cell_size,
+        math.ceil(max_lat / cell_size) * cell_size,
+    )
+
+
+def snap_time_range(start: datetime, end: datetime) -> Tuple[datetime, datetime]:
+    bucket = GRID_TIME_BUCKET_SECONDS
+    start_ts = math.floor(start.timestamp() / bucket) * bucket
+    end_ts = math.ceil(end.timestamp() / bucket) * bucket
+    return datetime.fromtimestamp(start_ts, timezone.utc), datetime.fromtimestamp(end_ts, timezone.utc)
+
+
+def cell_count(bbox: Tuple[float, ...], cell_size: float) -> int:
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return round((max_lon - min_lon) / cell_size) * round((max_lat - min_lat) / cell_size)
+
+
+def _cached(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return result
+
+
+def _store(key, result, expires_at: Optional[float]):
+    with _cache_lock:
+        _cache[key] = (expires_at, result)
+        _cache.move_to_end(key)
+        while len(_cache) > GRID_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+def merge_cells(results) -> list:
+    """Cells of several shards summed per grid point; mean speeds weighted by their number of samples"""
+    cells = {}
+    for rows in results:
+        for longitude, latitude, count, entities, mean_speed, speed_samples, dwell in rows:
+            cell = cells.setdefault((longitude, latitude), [0, 0, 0.0, 0, 0.0])
+            cell[0] += count
+            cell[1] += entities
+            cell[2] += float(mean_speed or 0) * speed_samples
+            cell[3] += speed_samples
+            cell[4] += float(dwell)
+    return [
+        {
+            "longitude": longitude,
+            "latitude": latitude,
+            "count": count,
+            "entities": entities,
+            "mean_speed_mps": speed_sum / speed_samples if speed_samples else None,
+            "dwell_seconds": dwell,
+        }
+        for (longitude, latitude), (count, entities, speed_sum, speed_samples, dwell) in cells.items()
+    ]
+
+
+def location_grid(bbox: Tuple[float, ...], zoom: int, start: datetime, end: datetime,
+                  entity_type: Optional[str] = None) -> dict:
+    """Counts, distinct entities, mean speed and dwell time per grid cell, computed in PostGIS on every shard,
+    merged and cached.
+
+    ``bbox`` and the time range must already be snapped (snap_bbox, snap_time_range);
+    they and ``zoom`` form the cache key.
+    """
+    cell_size = cell_size_degrees(zoom)
+    key = (bbox, zoom, start, end, entity_type)
+    result = _cached(key)
+    if result is not None:
+        return result
+
+    params = {
+        "start": start, "end": end, "cell_size": cell_size,
+        "min_lon": bbox[0], "min_lat": bbox[1], "max_lon": bbox[2], "max_lat": bbox[3],
+        "max_gap": GRID_MAX_GAP_SECONDS, "dwell_speed": GRID_DWELL_SPEED_MPS,
+    }
+    entity_filter = ""
+    if entity_type:
+        entity_filter = "AND entity_type = :entity_type"
+        params["entity_type"] = entity_type
+
+    if any(sharding.scatter_read(archive.has_archived_blocks, start, end)):
+        raise ArchivedRangeError(f"The range reaches into archived history (older than {archive.LOCATION_HOT_DAYS} days); "
+                                 "use /locations/export")
+
+    sql = text(GRID_SQL.format(entity_filter=entity_filter))
+    results = sharding.scatter_read(lambda db: db.execute(sql, params).all())
+    result = {
+        "cell_size": cell_size,
+        "bbox": list(bbox),
+        "start": start,
+        "end": end,
+        "cells": merge_cells(results),
+    }
+
+    still_open = end > datetime.now(timezone.utc) - timedelta(seconds=LOCATION_UPLOAD_MAX_AGE_SECONDS)
+    _store(key, result, time.monotonic() + GRID_CACHE_TTL_SECONDS if still_open else None)
+    return result
@@ -0,0 +1,309 @@
+"""Cold tier for location history: closed days moved out of ``locations`` into columnar block files.
+
+Each archive file holds one day (fixes of a day that arrive after it was
+archived go to another file on the next run); inside it every entity gets
+one block:
+
+    header   <4sHIqii  magic, format version, fix count, first timestamp (ms), first latitude and longitude (1e-7 deg)
+    payload  zlib(byte-shuffled int32 deltas of timestamp (ms), latitude and longitude (1e-7 deg),
+             speed (cm/s) and heading (0.01 deg), -1 where the fix had none)
+
+Version 1 blocks, written before speed and heading were kept, have only the
+first three columns and are still read.
+
+Per-second fixes differ by a few units from one to the next, so after delta
+encoding most bytes are zero; shuffling groups the bytes by significance
+before compression. The block index lives in ``location_archive_blocks``.
+Readers memory-map the files and decode straight from the mapping with
+``numpy.frombuffer``.
+
+Run ``python -m app.archive`` daily; it archives every day older than
+LOCATION_HOT_DAYS on every shard, each shard indexing its own blocks.
+LOCATION_ARCHIVE_DIR must be shared by all API instances.
+"""
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from itertools import groupby
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import insert, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models import LocationArchiveBlock
+
+
+logger = logging.getLogger(__name__)
+
+# Days of history kept as rows in ``locations``; older whole days are archived
+LOCATION_HOT_DAYS = int(os.getenv("LOCATION_HOT_DAYS", "90"))
+LOCATION_ARCHIVE_DIR = os.getenv("LOCATION_ARCHIVE_DIR", "./archive")
+LOCATION_ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("LOCATION_ARCHIVE_COMPRESSION_LEVEL", "9"))
+
+BLOCK_HEADER = struct.Struct("<4sHIqii")
+BLOCK_MAGIC = b"LCA1"
+BLOCK_VERSION = 2
+BLOCK_COLUMNS = {1: 3, 2: 5}  # int32 columns per format version
+COORDINATE_SCALE = 10_000_000  # 1e-7 degree, about 1 cm
+MOTION_SCALE = 100  # speed in cm/s, heading in 0.01 degree
+NO_VALUE = -1  # speed or heading not sent by the device
+
+INT32_MAX = np.iinfo(np.int32).max
+
+ArchivedFix = namedtuple("ArchivedFix", "id latitude longitude timestamp")
+
+
+# -------------------------------------------------------------
+# Block encoding
+# -------------------------------------------------------------
+
+def encode_block(timestamps_ms: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray,
+                 speeds: np.ndarray, headings: np.ndarray) -> bytes:
+    """Delta-encode, shuffle and compress one entity's fixes (in time order); missing speeds and headings are NaN"""
+    columns = np.stack([
+        timestamps_ms.astype(np.int64),
+        np.round(latitudes * COORDINATE_SCALE).astype(np.int64),
+        np.round(longitudes * COORDINATE_SCALE).astype(np.int64),
+        *(np.where(np.isnan(values), NO_VALUE, np.round(values * MOTION_SCALE)).astype(np.int64)
+          for values in (speeds, headings)),
+    ])
+    # Timestamps and coordinates start from the first fix, stored in the header; speed and heading from zero
+    start = np.zeros((len(columns), 1), dtype=np.int64)
+    start[:3] = columns[:3, :1]
+    deltas = np.diff(columns, axis=1, prepend=start)
+    if np.abs(deltas).max(initial=0) > INT32_MAX:
+        raise ValueError("Delta does not fit in 32 bits")
+
+    count = columns.shape[1]
+    shuffled = deltas.astype("<i4").view(np.uint8).reshape(len(columns), count, 4).transpose(0, 2, 1)
+    header = BLOCK_HEADER.pack(BLOCK_MAGIC, BLOCK_VERSION, count, *(int(v) for v in columns[:3, 0]))
+    return header + zlib.compress(shuffled.tobytes(), LOCATION_ARCHIVE_COMPRESSION_LEVEL)
+
+
+def decode_block(buffer) -> tuple:
+    """(timestamps in ms, latitudes, longitudes, speeds, headings) arrays from a block, read in place from
+    ``buffer``; missing speeds and headings are NaN"""
+    magic, version, count, first_ms, first_lat, first_lon = BLOCK_HEADER.unpack_from(buffer)
+    if magic != BLOCK_MAGIC or version not in BLOCK_COLUMNS:
+        raise ValueError(f"Not a version {' or '.join(map(str, BLOCK_COLUMNS))} archive block")
+
+    width = BLOCK_COLUMNS[version]
+    payload = zlib.decompress(memoryview(buffer)[BLOCK_HEADER.size:])
+    planes = np.frombuffer(payload, dtype=np.uint8).reshape(width, 4, count)
+    deltas = np.ascontiguousarray(planes.transpose(0, 2, 1)).view("<i4").reshape(width, count)
+
+    timestamps_ms = first_ms + np.cumsum(deltas[0], dtype=np.int64)
+    latitudes = (first_lat + np.cumsum(deltas[1], dtype=np.int64)) / COORDINATE_SCALE
+    longitudes = (first_lon + np.cumsum(deltas[2], dtype=np.int64)) / COORDINATE_SCALE
+    if width == 3:
+        speeds = headings = np.full(count, np.nan)
+    else:
+        speeds, headings = (np.where(values == NO_VALUE, np.nan, values / MOTION_SCALE)
+                            for values in np.cumsum(deltas[3:], axis=1, dtype=np.int64))
+    return timestamps_ms, latitudes, longitudes, speeds, headings
+
+
+# -------------------------------------------------------------
+# Reading
+# -------------------------------------------------------------
+
+_maps_lock = threading.Lock()
+_maps = {}
+
+
+def _mapped(path: str) -> mmap.mmap:
+    # Archive files never change once written, so one read-only mapping per file is shared by all requests
+    with _maps_lock:
+        mapping = _maps.get(path)
+        if mapping is None:
+            with open(os.path.join(LOCATION_ARCHIVE_DIR, path), "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[path] = mapping
+        return mapping
+
+
+def block_rows(block: LocationArchiveBlock, start: Optional[datetime] = None, end: Optional[datetime] = None,
+               newest_first: bool = False, skip: int = 0, limit: Optional[int] = None,
+               start_exclusive: bool = False) -> list:
+    """A block's fixes in [start, end) (or (start, end) with ``start_exclusive``) as LOCATION_ROW_COLUMNS tuples
+    followed by speed and heading (None when the device sent none), ``skip``/``limit`` applied in that order"""
+    view = memoryview(_mapped(block.path))[block.file_offset:block.file_offset + block.length]
+    timestamps_ms, latitudes, longitudes, speeds, headings = decode_block(view)
+
+    first = np.searchsorted(timestamps_ms, int(start.timestamp() * 1000),
+                            side="right" if start_exclusive else "left") if start else 0
+    last = np.searchsorted(timestamps_ms, int(end.timestamp() * 1000)) if end else len(timestamps_ms)
+    indexes = range(last - 1, first - 1, -1) if newest_first else range(first, last)
+    # Only the requested page is turned into tuples
+    indexes = indexes[skip:] if limit is None else indexes[skip:skip + limit]
+    return [
+        (block.entity_id, block.entity_type, float(latitudes[i]), float(longitudes[i]),
+         datetime.fromtimestamp(timestamps_ms[i] / 1000, timezone.utc),
+         None if np.isnan(speeds[i]) else float(speeds[i]), None if np.isnan(headings[i]) else float(headings[i]))
+        for i in indexes
+    ]
+
+
+def find_blocks_query(db: Session, entity_type: Optional[str] = None, entity_id: Optional[str] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None):
+    query = db.query(LocationArchiveBlock)
+    if entity_type:
+        query = query.filter(LocationArchiveBlock.entity_type == entity_type)
+    if entity_id:
+        query = query.filter(LocationArchiveBlock.entity_id == entity_id)
+    if start:
+        query = query.filter(LocationArchiveBlock.end_time >= start)
+    if end:
+        query = query.filter(LocationArchiveBlock.start_time < end)
+    return query
+
+
+def find_blocks(db: Session, entity_type: Optional[str] = None, entity_id: Optional[str] = None,
+                start: Optional[datetime] = None, end: Optional[datetime] = None, newest_first: bool = False):
+    query = find_blocks_query(db, entity_type, entity_id, start, end)
+    order = LocationArchiveBlock.start_time.desc() if newest_first else LocationArchiveBlock.start_time
+    return query.order_by(order, LocationArchiveBlock.id).all()
+
+
+def get_archived_rows_by_entity(db: Session, entity_type: str, entity_id: str, skip: int, limit: int) -> list:
+    """One entity's archived history, newest first, paginated like the hot table"""
+    rows = []
+    for block in find_blocks(db, entity_type, entity_id, newest_first=True):
+        if skip >= block.fix_count:
+            skip -= block.fix_count
+            continue
+        rows += block_rows(block, newest_first=True, skip=skip, limit=limit - len(rows))
+        skip = 0
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def get_archived_fixes_after(db: Session, entity_type: str, entity_id: str, after: Tuple[datetime, int],
+                             until: datetime, limit: int) -> List[ArchivedFix]:
+    """Archived fixes of one entity after the keyset position ``after`` and before ``until``, in time order,
+    shaped like crud.get_entity_fixes_after rows (archived fixes have id 0)"""
+    fixes = []
+    for block in find_blocks(db, entity_type, entity_id, after[0], until):
+        # Blocks come in start order, but fixes of a day that arrived late sit in a later, overlapping block
+        if len(fixes) >= limit and block.start_time > fixes[-1].timestamp:
+            break
+        # Table ids are positive, so no archived fix (id 0) at exactly after's timestamp comes after it
+        for _, _, latitude, longitude, timestamp, _, _ in block_rows(block, after[0], until, limit=limit,
+                                                                     start_exclusive=True):
+            fixes.append(ArchivedFix(0, latitude, longitude, timestamp))
+        fixes = sorted(fixes, key=lambda fix: fix.timestamp)[:limit]
+    return fixes
+
+
+def has_archived_blocks(db: Session, start: datetime, end: datetime) -> bool:
+    """Whether any fix in [start, end) has been moved to the archive"""
+    return db.query(find_blocks_query(db, start=start, end=end).exists()).scalar()
+
+
+def iter_archived_chunks(db: Session, start: datetime, end: datetime, entity_type: Optional[str] = None,
+                         entity_id: Optional[str] = None) -> Iterator[list]:
+    """Archived fixes in [start, end), one list of rows per block"""
+    for block in find_blocks(db, entity_type, entity_id, start, end):
+        rows = block_rows(block, start, end)
+        if rows:
+            yield rows
+
+
+# -------------------------------------------------------------
+# Archiving
+# -------------------------------------------------------------
+
+def archive_day(engine: Engine, day: datetime, name_prefix: str = "locations") -> int:
+    """Write one day's fixes to an archive file, index the blocks and delete the rows; returns the fix count"""
+    day_end = day + timedelta(days=1)
+    os.makedirs(LOCATION_ARCHIVE_DIR, exist_ok=True)
+    name = f"{name_prefix}_{day:%Y%m%d}_{int(time.time())}.lca"
+    path = os.path.join(LOCATION_ARCHIVE_DIR, name)
+    blocks, total = [], 0
+
+    # Read, index and delete in one snapshot: the DELETE removes exactly the rows written to the file, and
+    # fixes of the day committed meanwhile stay in the table for the next run
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn, conn.begin():
+        # A day sorted by entity takes longer than the API's statement timeout
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        with open(path + ".tmp", "wb") as out:
+            result = conn.execution_options(stream_results=True, yield_per=10000).execute(text(
+                "SELECT entity_type, entity_id, timestamp, ST_Y(coordinates), ST_X(coordinates), speed, heading "
+                "FROM locations WHERE timestamp >= :start AND timestamp < :end "
+                "ORDER BY entity_type, entity_id, timestamp"
+            ), {"start": day, "end": day_end})
+
+            for (entity_type, entity_id), fixes in groupby(result, key=lambda row: (row[0], row[1])):
+                fixes = list(fixes)
+                data = encode_block(
+                    np.fromiter((row[2].timestamp() * 1000 for row in fixes), dtype=np.float64,
+                                count=len(fixes)).round(),
+                    np.fromiter((row[3] for row in fixes), dtype=np.float64, count=len(fixes)),
+                    np.fromiter((row[4] for row in fixes), dtype=np.float64, count=len(fixes)),
+                    # None becomes NaN
+                    np.array([row[5] for row in fixes], dtype=np.float64),
+                    np.array([row[6] for row in fixes], dtype=np.float64),
+                )
+                blocks.append(dict(
+                    entity_type=entity_type, entity_id=entity_id, start_time=fixes[0][2], end_time=fixes[-1][2],
+                    fix_count=len(fixes), path=name, file_offset=out.tell(), length=len(data),
+                ))
+                out.write(data)
+                total += len(fixes)
+
+        if not blocks:
+            os.remove(path + ".tmp")
+            return 0
+
+        os.replace(path + ".tmp", path)
+        # The index and the delete commit together: a fix is either a row or archived
+        conn.execute(insert(LocationArchiveBlock), blocks)
+        conn.execute(text("DELETE FROM locations WHERE timestamp >= :start AND timestamp < :end"),
+                     {"start": day, "end": day_end})
+    logger.info(f"Archived {total} fixes of {day:%Y-%m-%d} ({len(blocks)} entities) to {name}, "
+                f"{os.path.getsize(path)} bytes")
+    return total
+
+
+def archive_closed_days(engine: Engine, hot_days: int = LOCATION_HOT_DAYS, today: datetime = None,
+                        name_prefix: str = "locations") -> int:
+    """Archive every whole UTC day older than the hot window; returns the number of fixes archived"""
+    today = (today or datetime.now(timezone.utc)).replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff = today - timedelta(days=hot_days)
+
+    with engine.begin() as conn:
+        # Backfilled fixes can be older than rows inserted before them, so ids don't give the oldest day;
+        # bounded by the cutoff, the BRIN index skips the recent part of the table
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        oldest = conn.execute(text("SELECT MIN(timestamp) FROM locations WHERE timestamp < :cutoff"),
+                              {"cutoff": cutoff}).scalar()
+    if oldest is None:
+        return 0
+
+    day = oldest.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    total = 0
+    while day < cutoff:
+        total += archive_day(engine, day, name_prefix)
+        day += timedelta(days=1)
+    return total
+
+
+def main():
+    from app.database import shards
+
+    logging.basicConfig(level=logging.INFO)
+    for shard in shards.values():
+        archive_closed_days(shard.engine, name_prefix=f"locations_{shard.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 from sqlalchemy.orm import Session
 from app.models import Location
 from geoalchemy2 import WKTElement
-from sqlalchemy import desc
-from typing import Optional
+from sqlalchemy import desc, text, insert
+from typing import List, Optional, Tuple
+from datetime import datetime
 
 
 def create_location(db: Session, entity_id: str, entity_type: str, latitude: float, longitude: float):
@@ -24,6 +25,25 @@ def create_location(db: Session, entity_id: str, entity_type: str, latitude: flo
     return db_location
 
 
+def create_locations(db: Session, entity_id: str, entity_type: str, fixes: List[dict]) -> int:
+    # Bulk insert of device fixes ({timestamp, latitude, longitude, speed, heading}) in one executemany
+    if not fixes:
+        return 0
+    db.execute(insert(Location), [
+        {
+            "entity_id": entity_id,
+            "entity_type": entity_type,
+            "coordinates": WKTElement(f"POINT({fix['longitude']} {fix['latitude']})", srid=4326),
+            "timestamp": fix["timestamp"],
+            "speed": fix.get("speed"),
+            "heading": fix.get("heading"),
+        }
+        for fix in fixes
+    ])
+    db.commit()
+    return len(fixes)
+
+
 def get_latest_location_by_entity_id(db: Session, entity_id: str):
     # Query for the most recent location record for the given entity_id
     return db.query(Location).filter(Location.entity_id == entity_id).order_by(
@@ -69,4 +89,104 @@ def get_latest_locations_by_entities(db: Session, entity_type: str = None):
         (Location.timestamp == subquery.c.max_timestamp)
     )
     
-    return query.all()
\ No newline at end of file
+    return query.all()
+
+
+# Columns in app.encoding.LOCATION_FIELDS order
+LOCATION_ROW_COLUMNS = "entity_id, entity_type, ST_Y(coordinates) AS latitude, ST_X(coordinates) AS longitude, timestamp"
+
+
+def get_location_version(db: Session, window: int) -> Tuple[int, int, int]:
+    # (highest location id, rows among the last `window` ids, highest archive block id). The highest id
+    # changes whenever any entity reports; the row count also changes when an insert holding a lower id
+    # commits late, and the archive block id when days are moved out of the table
+    return tuple(db.execute(text(
+        "WITH top AS (SELECT COALESCE(MAX(id), 0) AS max_id FROM locations) "
+        "SELECT max_id, (SELECT COUNT(*) FROM locations WHERE id > max_id - :window), "
+        "(SELECT COALESCE(MAX(id), 0) FROM location_archive_blocks) FROM top"
+    ), {"window": window}).one())
+
+
+def get_latest_location_rows(db: Session, entity_type: Optional[str] = None, after_id: Optional[int] = None):
+    # Latest (entity_id, entity_type, latitude, longitude, timestamp) per entity in one query,
+    # restricted to entities with a location newer than after_id when given
+    conditions, params = [], {}
+    if entity_type:
+        conditions.append("entity_type = :entity_type")
+        params["entity_type"] = entity_type
+
+    if not after_id:
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return db.execute(text(
+            f"SELECT DISTINCT ON (entity_type, entity_id) {LOCATION_ROW_COLUMNS} FROM locations {where} "
+            "ORDER BY entity_type, entity_id, timestamp DESC, id DESC"
+        ), params).all()
+
+    # New rows only select the entities: a backfilled fix older than the entity's latest one
+    # must not be reported as its position, so the latest row is looked up among all of its rows
+    conditions.append("id > :after_id")
+    params["after_id"] = after_id
+    return db.execute(text(
+        "SELECT latest.* FROM "
+        f"(SELECT DISTINCT entity_type, entity_id FROM locations WHERE {' AND '.join(conditions)}) AS changed "
+        f"CROSS JOIN LATERAL (SELECT {LOCATION_ROW_COLUMNS} FROM locations "
+        "WHERE locations.entity_type = changed.entity_type AND locations.entity_id = changed.entity_id "
+        "ORDER BY timestamp DESC, id DESC LIMIT 1) AS latest"
+    ), params).all()
+
+
+def get_latest_location_rows_for(db: Session, entities: List[Tuple[str, str]]):
+    # Latest row of each requested (entity_type, entity_id): one index probe per entity
+    # (idx_locations_entity_latest) instead of one query per entity
+    if not entities:
+        return []
+    entity_types, entity_ids = zip(*entities)
+    return db.execute(text(
+        "SELECT latest.* FROM unnest(CAST(:entity_types AS varchar[]), CAST(:entity_ids AS varchar[])) "
+        "AS wanted(entity_type, entity_id) "
+        f"CROSS JOIN LATERAL (SELECT {LOCATION_ROW_COLUMNS} FROM locations "
+        "WHERE locations.entity_type = wanted.entity_type AND locations.entity_id = wanted.entity_id "
+        "ORDER BY timestamp DESC, id DESC LIMIT 1) AS latest"
+    ), {"entity_types": list(entity_types), "entity_ids": list(entity_ids)}).all()
+
+
+def get_entity_fixes_after(db: Session, entity_type: str, entity_id: str, after: Tuple[datetime, int],
+                           until: datetime, limit: int):
+    # Next (id, latitude, longitude, timestamp) fixes of one entity in time order, keyset-paginated on
+    # (timestamp, id) so each page is a short index range scan
+    return db.execute(text(
+        "SELECT id, ST_Y(coordinates) AS latitude, ST_X(coordinates) AS longitude, timestamp FROM locations "
+        "WHERE entity_type = :entity_type AND entity_id = :entity_id "
+        "AND (timestamp, id) > (:after_timestamp, :after_id) AND timestamp < :until "
+        "ORDER BY timestamp, id LIMIT :limit"
+    ), {"entity_type": entity_type, "entity_id": entity_id, "after_timestamp": after[0], "after_id": after[1],
+        "until": until, "limit": limit}).all()
+
+
+def get_location_rows_by_entity(db: Session, entity_type: str, entity_id: str, skip: int = 0, limit: int = 100):
+    # One entity's history, newest first, as LOCATION_ROW_COLUMNS rows
+    return db.execute(text(
+        f"SELECT {LOCATION_ROW_COLUMNS} FROM locations WHERE entity_type = :entity_type AND entity_id = :entity_id "
+        "ORDER BY timestamp DESC OFFSET :skip LIMIT :limit"
+    ), {"entity_type": entity_type, "entity_id": entity_id, "skip": skip, "limit": limit}).all()
+
+
+def count_locations_by_entity(db: Session, entity_type: str, entity_id: str) -> int:
+    return db.query(Location).filter(Location.entity_type == entity_type, Location.entity_id == entity_id).count()
+
+
+def get_location_rows(db: Session, entity_id: Optional[str] = None, entity_type: Optional[str] = None,
+                      skip: int = 0, limit: int = 100):
+    # Locations newest first as LOCATION_ROW_COLUMNS rows, optionally filtered by entity
+    conditions, params = [], {"skip": skip, "limit": limit}
+    if entity_id:
+        conditions.append("entity_id = :entity_id")
+        params["entity_id"] = entity_id
+    if entity_type:
+        conditions.append("entity_type = :entity_type")
+        params["entity_type"] = entity_type
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    return db.execute(text(
+        f"SELECT {LOCATION_ROW_COLUMNS} FROM locations {where} ORDER BY timestamp DESC OFFSET :skip LIMIT :limit"
+    ), params).all()
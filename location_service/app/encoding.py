@@ -0,0 +1,23 @@
+import orjson
+
+from app.instrumentation import track
+
+
+# Column order of the location rows returned by the crud row queries
+LOCATION_FIELDS = ("entity_id", "entity_type", "latitude", "longitude", "timestamp")
+
+
+def location_objects(rows) -> list:
+    return [dict(zip(LOCATION_FIELDS, row)) for row in rows]
+
+
+@track("serialization")
+def encode_locations(rows) -> bytes:
+    """JSON array of location objects straight from SQL rows, without a Pydantic model per row"""
+    return orjson.dumps(location_objects(rows))
+
+
+@track("serialization")
+def encode_json(payload) -> bytes:
+    return orjson.dumps(payload)
+
@@ -0,0 +1,151 @@
+import io
+import os
+import csv
+import zlib
+import importlib.util
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app import archive
+from app.crud import LOCATION_ROW_COLUMNS
+from app.encoding import LOCATION_FIELDS
+
+
+# Rows fetched from the server-side cursor per round trip, and written per NDJSON/CSV chunk or Parquet row group
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "10000"))
+
+# Exported rows carry the speed and heading sent with binary uploads, None for other fixes
+EXPORT_FIELDS = LOCATION_FIELDS + ("speed", "heading")
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def parquet_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def iter_location_chunks(engine: Engine, start: datetime, end: datetime, entity_type: Optional[str] = None,
+                         entity_id: Optional[str] = None, chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[list]:
+    """Locations in [start, end) as lists of EXPORT_FIELDS tuples, fetched from a server-side cursor.
+
+    The connection is opened here rather than taken from the request's session,
+    which is closed before a streaming response is sent. Archived days come
+    first, block by block; table rows then follow in storage order, which
+    tracks insertion time closely; sorting would make PostgreSQL materialize
+    the whole range before the first byte.
+    """
+    conditions = ["timestamp >= :start", "timestamp < :end"]
+    params = {"start": start, "end": end}
+    if entity_type:
+        conditions.append("entity_type = :entity_type")
+        params["entity_type"] = entity_type
+    if entity_id:
+        conditions.append("entity_id = :entity_id")
+        params["entity_id"] = entity_id
+
+    # Archived days first: they are older than anything still in the table
+    with Session(bind=engine) as db:
+        yield from archive.iter_archived_chunks(db, start, end, entity_type, entity_id)
+
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_rows).execute(
+            text(f"SELECT {LOCATION_ROW_COLUMNS}, speed, heading FROM locations WHERE {' AND '.join(conditions)}"), params
+        )
+        for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+
+def encode_ndjson(chunks: Iterable[list]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield b"".join(orjson.dumps(dict(zip(EXPORT_FIELDS, row))) + b"\n" for row in rows)
+
+
+def encode_csv(chunks: Iterable[list]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for rows in chunks:
+        writer.writerows((entity_id, entity_type, latitude, longitude, timestamp.isoformat(), speed, heading)
+                         for entity_id, entity_type, latitude, longitude, timestamp, speed, heading in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file handing out what was written since the last ``take``, for streaming Parquet"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def encode_parquet(chunks: Iterable[list]) -> Iterator[bytes]:
+    """One Parquet row group per chunk; the footer goes out last"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("entity_id", pa.string()),
+        ("entity_type", pa.string()),
+        ("latitude", pa.float64()),
+        ("longitude", pa.float64()),
+        ("timestamp", pa.timestamp("us", tz="UTC")),
+        ("speed", pa.float64()),
+        ("heading", pa.float64()),
+    ])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in chunks:
+            columns = zip(*rows)
+            writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)],
+                                                    schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+ENCODERS = {"ndjson": encode_ndjson, "csv": encode_csv, "parquet": encode_parquet}
+
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_locations(engines: List[Engine], export_format: str, start: datetime, end: datetime,
+                     entity_type: Optional[str] = None, entity_id: Optional[str] = None,
+                     gzip: bool = False) -> Iterator[bytes]:
+    """Encoded export body from each shard's engine in turn, produced chunk by chunk with flat memory use"""
+    chunks = (chunk for engine in engines for chunk in iter_location_chunks(engine, start, end, entity_type, entity_id))
+    body = ENCODERS[export_format](chunks)
+    return gzip_stream(body) if gzip else body
@@ -1,21 +1,40 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests as req 
-url = "http://172.30.80.11:31006/auth/"
+from app.instrumentation import track
+url = os.getenv("AUTH_BASE_URL", "http://172.30.80.11:31006/auth/")
+# Seconds to wait for the Auth Service (connect and read) before the request fails with 503
+AUTH_TIMEOUT_SECONDS = float(os.getenv("AUTH_TIMEOUT_SECONDS", "5"))
+# Bulk checks (POST /locations/latest:batch): how long a confirmed (id, role) is trusted, and parallel lookups
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+AUTH_LOOKUP_CONCURRENCY = int(os.getenv("AUTH_LOOKUP_CONCURRENCY", "16"))
+# Confirmed (id, role) pairs kept at most; the least recently used are evicted first
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+_session = req.Session()
+_session.mount("http://", req.adapters.HTTPAdapter(pool_maxsize=AUTH_LOOKUP_CONCURRENCY))
+_session.mount("https://", req.adapters.HTTPAdapter(pool_maxsize=AUTH_LOOKUP_CONCURRENCY))
+_lookup_pool = ThreadPoolExecutor(max_workers=AUTH_LOOKUP_CONCURRENCY, thread_name_prefix="auth-lookup")
+_validated_lock = threading.Lock()
+_validated = OrderedDict()  # (id, role) -> expiry (monotonic seconds), least recently used first
 def get_auth_token()->(str,str):
     data = {
         "email":"admin@test.com",
         "password":"password"
     }
 
-    url = "http://172.30.80.11:31006/auth/"
-    url = url+"login"
-    resp = req.post(url,json=data)
+    login_url = url+"login"
+    resp = req.post(login_url,json=data,timeout=AUTH_TIMEOUT_SECONDS)
     if resp.ok:
         return resp.json()["accessToken"],None
     return "",str(resp.text)
 
+@track("auth")
 def check_user_exists(id:int,role:str):
     token = get_auth_token()
-    url = "http://172.30.80.11:31006/auth/"
     data = {
         "email":"admin@test.com",
         "password":"password"
@@ -23,8 +42,7 @@ def check_user_exists(id:int,role:str):
     headers = {
         "Authorization":"Bearer "+token[0]
     }
-    url = url+f"user/{id}"
-    resp = req.get(url,headers=headers)
+    resp = req.get(url+f"user/{id}",headers=headers,timeout=AUTH_TIMEOUT_SECONDS)
     if resp.ok:
         data = resp.json()
         data_role = data["role"].lower()
@@ -33,5 +51,54 @@ def check_user_exists(id:int,role:str):
         print(resp.json())
         return False,f"User {id} is of type {data_role}"
     return None,"User Doesn't Exist"
-# print(get_auth_token())
-print(check_user_exists(2,"admin"))
\ No newline at end of file
+
+
+def role_matches(data_role: str, role: str) -> bool:
+    return data_role == role.lower() or (role.lower() == "bus" and data_role == "chauffeur")
+
+
+def _lookup_user(id: int, role: str, headers: dict):
+    resp = _session.get(url + f"user/{id}", headers=headers, timeout=AUTH_TIMEOUT_SECONDS)
+    if resp.ok:
+        data_role = resp.json()["role"].lower()
+        if role_matches(data_role, role):
+            return None
+        return f"User {id} is of type {data_role}"
+    return "User Doesn't Exist"
+
+
+@track("auth")
+def check_users_exist(entities):
+    """Check many (id, role) pairs at once: one login, then the uncached users looked up in parallel.
+
+    The Auth Service has no bulk endpoint, so this is the closest to a single
+    check: confirmed pairs are cached for AUTH_CACHE_TTL_SECONDS (at most
+    AUTH_CACHE_MAX_ENTRIES of them) and the rest
+    share one token and a keep-alive session. Returns {(id, role): error or None};
+    raises when the Auth Service cannot be reached.
+    """
+    now = time.monotonic()
+    with _validated_lock:
+        results = {key: None for key in set(entities) if _validated.get(key, 0) > now}
+        for key in results:
+            _validated.move_to_end(key)
+    pending = [key for key in set(entities) if key not in results]
+    if not pending:
+        return results
+
+    token, error = get_auth_token()
+    if not token:
+        raise RuntimeError(f"Auth Service login failed: {error}")
+    headers = {"Authorization": "Bearer " + token}
+
+    errors = list(_lookup_pool.map(lambda key: _lookup_user(key[0], key[1], headers), pending))
+    expires_at = time.monotonic() + AUTH_CACHE_TTL_SECONDS
+    with _validated_lock:
+        for key, error in zip(pending, errors):
+            results[key] = error
+            if error is None:
+                _validated[key] = expires_at
+                _validated.move_to_end(key)
+        while len(_validated) > AUTH_CACHE_MAX_ENTRIES:
+            _validated.popitem(last=False)
+    return results
@@ -0,0 +1,262 @@
+import os
+import re
+import sys
+import time
+import random
+import logging
+import threading
+import functools
+import contextvars
+from collections import Counter, defaultdict
+from typing import Dict, Optional
+
+import fastapi.routing
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+logger = logging.getLogger(__name__)
+
+# Critical requests must finish within 2 s; slower ones are logged (and profiled when enabled)
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2.0"))
+# More statements than this in one request is almost always an N+1 query
+SQL_STATEMENTS_WARN = int(os.getenv("SQL_STATEMENTS_WARN", "20"))
+# Opt-in sampling profiler: fraction of requests sampled (0 disables it), sampling interval and output directory
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+REQUEST_SECONDS = Histogram(
+    "location_request_seconds", "Request latency", ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+REQUEST_PHASE_SECONDS = Histogram(
+    "location_request_phase_seconds", "Time per request spent in the database, the Auth Service and serialization",
+    ["route", "phase"], buckets=LATENCY_BUCKETS
+)
+SQL_STATEMENTS = Histogram(
+    "location_request_sql_statements", "SQL statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+)
+POOL_WAIT_SECONDS = Histogram(
+    "location_db_pool_checkout_seconds", "Time to get a connection from the pool (waiting or connecting)",
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+POOL_CHECKED_OUT = Gauge("location_db_pool_checked_out", "Connections currently checked out of the pool", ["pool"])
+
+PHASES = ("db", "auth", "serialization")
+
+
+class RequestTimings:
+    """Per-request accumulators, reached from any thread through a context variable"""
+
+    __slots__ = ("db", "auth", "serialization", "statements", "threads")
+
+    def __init__(self):
+        self.db = 0.0
+        self.auth = 0.0
+        self.serialization = 0.0
+        self.statements = 0
+        self.threads = set()
+
+
+_current: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("request_timings", default=None)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+def track(phase: str):
+    """Decorator adding a function's wall time to the current request's ``phase``"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _current.get()
+            if timings is None:
+                return func(*args, **kwargs)
+            timings.threads.add(threading.get_ident())
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(timings, phase, getattr(timings, phase) + time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# -------------------------------------------------------------
+# Database hooks
+# -------------------------------------------------------------
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout takes (pool wait, or connect for a new connection)"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine: Engine, pool_name: str = "primary"):
+    """Count statements and database time per request, and export the pool's checked-out connections"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        timings = _current.get()
+        if timings is not None:
+            timings.db += elapsed
+            timings.statements += 1
+            timings.threads.add(threading.get_ident())
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+    if hasattr(engine.pool, "checkedout"):
+        POOL_CHECKED_OUT.labels(pool_name).set_function(engine.pool.checkedout)
+
+
+# -------------------------------------------------------------
+# Sampling profiler
+# -------------------------------------------------------------
+
+def fold_stack(frame) -> str:
+    """One stack in the collapsed "outer;...;inner" format read by flamegraph.pl and speedscope"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """Samples every thread's stack at a fixed interval from a background thread"""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = defaultdict(Counter)  # thread ident -> folded stack -> count
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples[ident][fold_stack(frame)] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path: str, threads: set):
+        """Write the samples of ``threads`` (the ones that served the request) as folded stacks"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as out:
+            for ident, stacks in self.samples.items():
+                if ident not in threads:
+                    continue
+                for stack, count in stacks.items():
+                    out.write(f"{stack} {count}\n")
+
+
+# -------------------------------------------------------------
+# Request middleware and metrics endpoint
+# -------------------------------------------------------------
+
+def route_of(request: Request) -> str:
+    """Route template rather than the raw path, to keep label cardinality bounded"""
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def _timed_serialize_response(serialize_response):
+    """Wrap FastAPI's response-model validation/encoding so it counts as serialization time"""
+    @functools.wraps(serialize_response)
+    async def wrapper(*args, **kwargs):
+        timings = _current.get()
+        started = time.perf_counter()
+        try:
+            return await serialize_response(*args, **kwargs)
+        finally:
+            if timings is not None:
+                timings.serialization += time.perf_counter() - started
+    return wrapper
+
+
+def instrument_app(app: FastAPI, engines: Dict[str, Engine]):
+    """Install per-request latency metrics, the SQLAlchemy hooks on ``engines`` (by pool label) and GET /metrics"""
+    instrumented = []
+    for pool_name, engine in engines.items():
+        if not any(engine is seen for seen in instrumented):
+            instrument_engine(engine, pool_name=pool_name)
+            instrumented.append(engine)
+    if not getattr(fastapi.routing.serialize_response, "__wrapped__", None):
+        fastapi.routing.serialize_response = _timed_serialize_response(fastapi.routing.serialize_response)
+
+    @app.middleware("http")
+    async def record_request_timings(request: Request, call_next):
+        timings = RequestTimings()
+        timings.threads.add(threading.get_ident())
+        token = _current.set(timings)
+        sampler = StackSampler().start() if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE else None
+
+        started = time.perf_counter()
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            if sampler is not None:
+                sampler.stop()
+
+            route = route_of(request)
+            REQUEST_SECONDS.labels(request.method, route, str(status_code)).observe(elapsed)
+            for phase in PHASES:
+                REQUEST_PHASE_SECONDS.labels(route, phase).observe(getattr(timings, phase))
+            SQL_STATEMENTS.labels(route).observe(timings.statements)
+
+            if timings.statements > SQL_STATEMENTS_WARN:
+                logger.warning(f"{request.method} {request.url.path} ran {timings.statements} SQL statements")
+            if elapsed > SLOW_REQUEST_SECONDS:
+                logger.warning(
+                    f"Slow request {request.method} {request.url.path}: {elapsed:.2f}s "
+                    f"(db {timings.db:.2f}s, auth {timings.auth:.2f}s, serialization {timings.serialization:.2f}s, "
+                    f"{timings.statements} statements)"
+                )
+                if sampler is not None:
+                    name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+                    path = os.path.join(PROFILE_DIR, f"{int(time.time())}_{request.method}_{name}_{elapsed * 1000:.0f}ms.folded")
+                    sampler.dump(path, timings.threads)
+                    logger.warning(f"Profile of the slow request written to {path}")
+
+        response.headers["Server-Timing"] = (
+            f"db;dur={timings.db * 1000:.1f}, auth;dur={timings.auth * 1000:.1f}, "
+            f"serialization;dur={timings.serialization * 1000:.1f}, total;dur={elapsed * 1000:.1f}"
+        )
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
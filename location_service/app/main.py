@@ -1,21 +1,47 @@
 from fastapi.routing import APIRoute
-from fastapi import FastAPI, HTTPException, Depends, Path
+from fastapi import FastAPI, HTTPException, Depends, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from app import schemas, crud, models
-from app.database import SessionLocal, engine
+from app import schemas, crud
+from app.database import pool_engines
 from typing import List, Optional
-from .get_auth import check_user_exists
+from datetime import datetime, timezone
+from .get_auth import check_user_exists, check_users_exist
+from app.instrumentation import instrument_app
+from app.encoding import encode_locations, encode_json, location_objects
+from app import export, aggregation, replay, archive, upload, sharding
 import os
+import hashlib
 
 
-models.Base.metadata.create_all(bind=engine)
+# The schema is created by the migration step (python -m app.migrate), not on import
+
+# Delta responses (?since=) re-scan this many ids below the client's version, and the ETag covers them:
+# ids are taken at insert time but become visible at commit, so an older id can appear after newer ones.
+# Never less than one binary upload, which inserts that many rows in one transaction
+LOCATION_DELTA_OVERLAP = max(int(os.getenv("LOCATION_DELTA_OVERLAP", "10000")), upload.LOCATION_UPLOAD_MAX_FIXES)
+# Most entities one POST /locations/latest:batch may ask for
+LOCATION_BATCH_MAX_ENTITIES = int(os.getenv("LOCATION_BATCH_MAX_ENTITIES", "500"))
 
 app = FastAPI(title="Location Service", description="Service for tracking GPS locations of students and buses")
 
+# Per-route latency, DB/auth/serialization time, SQL statement counts and pool waits, served on /metrics
+instrument_app(app, pool_engines())
+
 
-def get_db():
-    db = SessionLocal()
+def get_db(entity_type: str, entity_id: str):
+    """Session on the primary of the shard owning the entity in the path"""
+    db = sharding.shard_for(entity_type, entity_id).SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(entity_type: str, entity_id: str):
+    """Session on the read replica of the shard owning the entity in the path; may lag the primary slightly"""
+    db = sharding.shard_for(entity_type, entity_id).ReadSessionLocal()
     try:
         yield db
     finally:
@@ -68,6 +94,39 @@ def create_location(
     return {"message": f"Location for {entity_type} {entity_id} created successfully"}
 
 
+@app.post(
+    "/locations/{entity_type}/{entity_id}/batch",
+    status_code=201,
+    summary="Upload a batch of fixes (binary)",
+    description=f"Tracker devices upload buffered fixes in the compact binary format ({upload.CONTENT_TYPE}): "
+                "a 16-byte header, then 12 bytes per fix (16 with speed and heading). See app/upload.py."
+)
+async def upload_locations(
+    request: Request,
+    entity_type: str = Path(..., regex="^(student|bus)$"),
+    entity_id: str = Path(...),
+    db: Session = Depends(get_db)
+):
+    try:
+        columns = upload.decode_batch(await request.body())
+    except upload.UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        exists, error_msg = await run_in_threadpool(check_user_exists, int(entity_id), entity_type)
+        if not exists:
+            raise HTTPException(status_code=404, detail=f"Auth Service Error: {error_msg}")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Entity ID must be an integer to check against Auth service")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Could not connect to Auth Service: {str(e)}")
+
+    created = await run_in_threadpool(crud.create_locations, db, entity_id, entity_type, upload.to_fixes(columns))
+    return {"message": f"{created} locations for {entity_type} {entity_id} created successfully"}
+
+
 @app.get(
     "/locations/entity/{entity_type}/{entity_id}",
     response_model=List[schemas.LocationResponse],
@@ -79,7 +138,7 @@ def get_locations_by_entity(
     entity_id: str = Path(...),
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     try:
         exists, error_msg = check_user_exists(int(entity_id), entity_type)
@@ -87,112 +146,256 @@ def get_locations_by_entity(
             raise HTTPException(status_code=404, detail=f"User not found: {error_msg}")
     except ValueError:
         pass
-    locations = crud.get_locations_by_entity(db=db, entity_type=entity_type, entity_id=entity_id, skip=skip, limit=limit)
-    
-    result = []
-    for location in locations:
-        result_query = db.execute(
-            text("SELECT ST_X(coordinates::geometry) as longitude, ST_Y(coordinates::geometry) as latitude FROM locations WHERE id = :location_id"),
-            {"location_id": location.id}
-        ).first()
-        
-        if result_query:
-            longitude, latitude = result_query
-        else:
-            longitude, latitude = 0.0, 0.0
-            
-        result.append(schemas.LocationResponse(
-            entity_id=location.entity_id,
-            entity_type=location.entity_type,
-            latitude=latitude,
-            longitude=longitude,
-            timestamp=location.timestamp
-        ))
-        
-    return result
+    rows = entity_history_rows(db, entity_type, entity_id, skip, limit)
+    return Response(encode_locations(rows), media_type="application/json")
+
+
+def entity_history_rows(db: Session, entity_type: str, entity_id: str, skip: int, limit: int) -> list:
+    # One entity's history newest first, continuing into the archived days when the page runs past the hot table
+    rows = crud.get_location_rows_by_entity(db=db, entity_type=entity_type, entity_id=entity_id, skip=skip, limit=limit)
+    if len(rows) < limit:
+        hot_count = len(rows) + skip if rows else crud.count_locations_by_entity(db, entity_type, entity_id)
+        rows += archive.get_archived_rows_by_entity(db, entity_type, entity_id, max(skip - hot_count, 0), limit - len(rows))
+    return rows
 
 @app.get(
     "/entities/locations",
     response_model=List[schemas.EntityLocationResponse],
     summary="Get latest locations of all entities",
-    description="Retrieve the latest GPS locations for all entities, optionally filtered by entity type."
+    description="Retrieve the latest GPS locations for all entities, optionally filtered by entity type. "
+                "Send the ETag back in If-None-Match to get 304 when nothing moved, or pass X-Location-Version "
+                "as `since` to get only the entities that reported after it."
 )
 def get_all_entities_latest_locations(
+    request: Request,
     entity_type: Optional[str] = None,
-    db: Session = Depends(get_db)
+    since: Optional[str] = None
 ):
-    locations = crud.get_latest_locations_by_entities(db=db, entity_type=entity_type)
-    
-    result = []
-    for location in locations:
-        result_query = db.execute(
-            text("SELECT ST_X(coordinates::geometry) as longitude, ST_Y(coordinates::geometry) as latitude FROM locations WHERE id = :location_id"),
-            {"location_id": location.id}
-        ).first()
-        
-        if result_query:
-            longitude, latitude = result_query
+    states = sharding.scatter_read(crud.get_location_version, LOCATION_DELTA_OVERLAP)
+    version = sharding.format_version([state[0] for state in states])
+    etag = f'"{version}:{location_digest(states)}"'
+    headers = {"ETag": etag, "X-Location-Version": version, "Cache-Control": "no-cache"}
+
+    # The ETag's value (quotes stripped) is accepted as well
+    since_versions = sharding.parse_version(since.split(":")[0]) if since is not None else None
+    if since is not None and since_versions is None:
+        raise HTTPException(status_code=400, detail="since must be a version returned by this endpoint")
+    # No 304 from `since` alone: a late commit below the client's version doesn't raise the version
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    def latest(shard, after_id):
+        with shard.ReadSessionLocal() as db:
+            return crud.get_latest_location_rows(db=db, entity_type=entity_type, after_id=after_id)
+
+    after_ids = dict(zip(sharding.shards, [max(s - LOCATION_DELTA_OVERLAP, 0) for s in since_versions])) if since_versions else {}
+    results = sharding.scatter(lambda shard: latest(shard, after_ids.get(shard.name)))
+    rows = merge_latest(row for shard_rows in results for row in shard_rows)
+    return Response(encode_locations(rows), media_type="application/json", headers=headers)
+
+
+def location_digest(states) -> str:
+    # Late commits and archive runs change the per-shard states without raising the version
+    return hashlib.blake2b(repr(states).encode(), digest_size=6).hexdigest()
+
+
+def merge_latest(rows) -> list:
+    # An entity re-homed by a shard map change can have rows on two shards: keep the newest
+    latest = {}
+    for row in rows:
+        key = (row[1], row[0])
+        if key not in latest or row[4] > latest[key][4]:
+            latest[key] = row
+    return list(latest.values())
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+@app.post(
+    "/locations/latest:batch",
+    response_model=schemas.LatestLocationsBatchResponse,
+    summary="Get latest locations of many entities",
+    description="Latest GPS location of each requested (entity_type, entity_id) in one call. "
+                "Entities the Auth Service does not know, or that have another role, are listed in `errors`; "
+                "entities without any location are simply absent from `locations`."
+)
+def get_latest_locations_batch(
+    batch: schemas.LatestLocationsBatchRequest
+):
+    if len(batch.entities) > LOCATION_BATCH_MAX_ENTITIES:
+        raise HTTPException(status_code=400, detail=f"At most {LOCATION_BATCH_MAX_ENTITIES} entities per batch")
+
+    requested = {}
+    for entity in batch.entities:
+        try:
+            requested[(entity.entity_type, entity.entity_id)] = (int(entity.entity_id), entity.entity_type)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Entity ID {entity.entity_id} must be an integer to check against Auth service")
+
+    try:
+        checks = check_users_exist(list(requested.values()))
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Could not connect to Auth Service: {str(e)}")
+
+    valid, errors = [], []
+    for (entity_type, entity_id), key in requested.items():
+        if checks[key] is None:
+            valid.append((entity_type, entity_id))
         else:
-            longitude, latitude = 0.0, 0.0
-            
-        result.append(schemas.EntityLocationResponse(
-            entity_id=location.entity_id,
-            entity_type=location.entity_type,
-            latitude=latitude,
-            longitude=longitude,
-            timestamp=location.timestamp
-        ))
-        
-    return result
+            errors.append({"entity_type": entity_type, "entity_id": entity_id, "error": checks[key]})
+
+    groups = sharding.group_by_shard(valid)
+    targets = [sharding.shards[name] for name in groups]
+
+    def latest(shard):
+        with shard.ReadSessionLocal() as db:
+            return crud.get_latest_location_rows_for(db=db, entities=groups[shard.name])
+
+    rows = [row for shard_rows in sharding.scatter(latest, targets) for row in shard_rows] if targets else []
+    return Response(encode_json({"locations": location_objects(rows), "errors": errors}), media_type="application/json")
 
 
 @app.get(
     "/locations/",
     response_model=List[schemas.LocationResponse],
     summary="Get locations",
-    description="Retrieve a list of locations. You can optionally filter by entity ID or entity type and paginate with skip/limit."
+    description="Retrieve a list of locations. You can optionally filter by entity ID or entity type and paginate with skip/limit. "
+                "Archived days are included when both entity_id and entity_type are given; otherwise the list covers "
+                "the last LOCATION_HOT_DAYS days, use /locations/export for older history."
 )
 def get_locations(
     entity_id: Optional[str] = None,
     entity_type: Optional[str] = None,
     skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db)
+    limit: int = 100
 ):
-    
-    query = db.query(models.Location)
-    
-    if entity_id:
-        query = query.filter(models.Location.entity_id == entity_id)
-    if entity_type:
-        query = query.filter(models.Location.entity_type == entity_type)
-    
-    locations = query.order_by(models.Location.timestamp.desc()).offset(skip).limit(limit).all()
-    
-    result = []
-    for location in locations:
-        
-        result_query = db.execute(
-            text("SELECT ST_X(coordinates::geometry) as longitude, ST_Y(coordinates::geometry) as latitude FROM locations WHERE id = :location_id"),
-            {"location_id": location.id}
-        ).first()
-        
-        if result_query:
-            longitude, latitude = result_query
-        else:
-            longitude, latitude = 0.0, 0.0
-            
-        result.append(schemas.LocationResponse(
-            entity_id=location.entity_id,
-            entity_type=location.entity_type,
-            latitude=latitude,
-            longitude=longitude,
-            timestamp=location.timestamp
-        ))
-        
-    return result
+    if entity_id and entity_type:
+        with sharding.shard_for(entity_type, entity_id).ReadSessionLocal() as db:
+            rows = entity_history_rows(db, entity_type, entity_id, skip, limit)
+        return Response(encode_locations(rows), media_type="application/json")
+
+    targets = list(sharding.shards.values())
+    if len(targets) == 1:
+        rows = sharding.scatter_read(crud.get_location_rows, entity_id, entity_type, skip, limit, targets=targets)[0]
+    else:
+        # Each shard's first skip + limit rows, merged newest first
+        results = sharding.scatter_read(crud.get_location_rows, entity_id, entity_type, 0, skip + limit, targets=targets)
+        rows = sorted((row for shard_rows in results for row in shard_rows), key=lambda row: row[4], reverse=True)
+        rows = rows[skip:skip + limit]
+    return Response(encode_locations(rows), media_type="application/json")
+
+
+@app.get(
+    "/locations/export",
+    summary="Export location history",
+    description="Stream every location in [start, end) as NDJSON, CSV or Parquet, optionally filtered by entity. "
+                "The body is gzip-compressed when the client accepts it (NDJSON and CSV; Parquet is compressed already)."
+)
+def export_locations(
+    request: Request,
+    start: datetime,
+    end: Optional[datetime] = None,
+    entity_type: Optional[str] = Query(None, regex="^(student|bus)$"),
+    entity_id: Optional[str] = None,
+    format: str = Query("ndjson", regex="^(ndjson|csv|parquet)$")
+):
+    start, end = as_utc(start), as_utc(end or datetime.now(timezone.utc))
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if format == "parquet" and not export.parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+
+    media_type, extension = export.EXPORT_FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="locations_{start:%Y%m%d}_{end:%Y%m%d}.{extension}"'}
+    gzip = format != "parquet" and "gzip" in request.headers.get("accept-encoding", "")
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+
+    # Streams from its own replica connections, shard after shard: the request's session would be closed
+    # before the body is sent
+    if entity_type and entity_id:
+        engines = [sharding.shard_for(entity_type, entity_id).read_engine]
+    else:
+        engines = [shard.read_engine for shard in sharding.shards.values()]
+    body = export.export_locations(engines, format, start, end, entity_type, entity_id, gzip=gzip)
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+
+@app.get(
+    "/locations/grid",
+    summary="Aggregate locations on a grid",
+    description="Bin the locations inside a bounding box and time range into grid cells sized for the map zoom, "
+                "with the number of fixes, distinct entities, mean speed and dwell time per cell. "
+                "The box is widened to whole cells and the range to whole time buckets; results are cached. "
+                "Ranges reaching into archived days are refused."
+)
+def get_location_grid(
+    min_lon: float = Query(..., ge=-180, le=180),
+    min_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    start: datetime = Query(...),
+    end: Optional[datetime] = None,
+    zoom: int = Query(14, ge=0, le=22),
+    entity_type: Optional[str] = Query(None, regex="^(student|bus)$")
+):
+    start, end = as_utc(start), as_utc(end or datetime.now(timezone.utc))
+    if end <= start or max_lon <= min_lon or max_lat <= min_lat:
+        raise HTTPException(status_code=400, detail="Empty bounding box or time range")
+
+    cell_size = aggregation.cell_size_degrees(zoom)
+    bbox = aggregation.snap_bbox(min_lon, min_lat, max_lon, max_lat, cell_size)
+    if aggregation.cell_count(bbox, cell_size) > aggregation.GRID_MAX_CELLS:
+        raise HTTPException(status_code=400, detail="Too many grid cells: zoom out or shrink the bounding box")
+
+    start, end = aggregation.snap_time_range(start, end)
+    try:
+        grid = aggregation.location_grid(bbox, zoom, start, end, entity_type)
+    except aggregation.ArchivedRangeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(encode_json(grid), media_type="application/json")
+
+
+@app.get(
+    "/locations/replay/{entity_type}/{entity_id}",
+    summary="Replay a trip",
+    description="Server-sent events replaying an entity's stored fixes in [start, end) with their original timing "
+                "divided by `speed`. `fps` adds interpolated positions between fixes; `seek` starts the replay at a "
+                "given time, and reconnecting with Last-Event-ID resumes after the last fix received."
+)
+def replay_locations(
+    request: Request,
+    entity_type: str = Path(..., regex="^(student|bus)$"),
+    entity_id: str = Path(...),
+    start: datetime = Query(...),
+    end: Optional[datetime] = None,
+    seek: Optional[datetime] = None,
+    speed: float = Query(1.0, gt=0, le=1000),
+    fps: float = Query(0, ge=0, le=replay.REPLAY_MAX_FPS)
+):
+    start, end = as_utc(start), as_utc(end or datetime.now(timezone.utc))
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+
+    after = replay.seek_position(max(as_utc(seek), start) if seek else start)
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        after = replay.parse_event_id(last_event_id) or after
+
+    events = replay.replay_events(entity_type, entity_id, after, end, speed, fps)
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
+def as_utc(value: datetime) -> datetime:
+    # Naive times are taken as UTC, like the stored timestamps
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
 
 
 @app.get("/", summary="Root endpoint", description=" All endpoints and their descriptions")
@@ -0,0 +1,42 @@
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from app import models
+
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(engine: Engine):
+    """Create the PostGIS extension and missing tables.
+
+    Run once per deployment (``python -m app.migrate``) before the API starts;
+    the API no longer touches the schema on boot.
+    """
+    with engine.begin() as conn:
+        # The API's statement timeout would cut index builds on a large table short
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+        models.Base.metadata.create_all(bind=conn)
+        # Columns added after the table was first created
+        conn.execute(text("ALTER TABLE locations ADD COLUMN IF NOT EXISTS speed double precision, "
+                          "ADD COLUMN IF NOT EXISTS heading double precision"))
+        # create_all skips indexes added to tables that already exist
+        for index in models.Location.__table__.indexes | models.LocationArchiveBlock.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+    logger.info("Schema up to date")
+
+
+def main():
+    from app.database import shards
+
+    logging.basicConfig(level=logging.INFO)
+    for shard in shards.values():
+        logger.info(f"Migrating shard {shard.name}")
+        migrate(shard.engine)
+
+
+if __name__ == "__main__":
+    main()
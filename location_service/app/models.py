@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float
 from sqlalchemy.sql import func
 from app.database import Base
 from geoalchemy2 import Geometry
@@ -13,7 +13,33 @@ class Location(Base):
     entity_type = Column(String, nullable=False)  # 'student' or 'bus'
     coordinates = Column(Geometry(geometry_type='POINT', srid=4326), nullable=False)  # GPS coordinates
     timestamp = Column(DateTime(timezone=True), server_default=func.now())  # Time when location was recorded
+    speed = Column(Float, nullable=True)  # m/s, from binary tracker uploads only
+    heading = Column(Float, nullable=True)  # Degrees clockwise from north, from binary tracker uploads only
 
 
 # Create index on entity_id for faster queries
-Index('idx_locations_entity_id', Location.entity_id)
\ No newline at end of file
+Index('idx_locations_entity_id', Location.entity_id)
+# Latest location per entity (DISTINCT ON entity_type, entity_id ORDER BY timestamp DESC)
+Index('idx_locations_entity_latest', Location.entity_type, Location.entity_id, Location.timestamp.desc())
+# Time-range scans (GET /locations/export): rows arrive in timestamp order, so a BRIN index stays tiny
+Index('idx_locations_timestamp_brin', Location.timestamp, postgresql_using='brin')
+
+
+class LocationArchiveBlock(Base):
+    """One entity's fixes for one closed day, stored as a compressed columnar block in an archive file"""
+    __tablename__ = "location_archive_blocks"
+
+    id = Column(Integer, primary_key=True)
+    entity_type = Column(String, nullable=False)
+    entity_id = Column(String, nullable=False)
+    start_time = Column(DateTime(timezone=True), nullable=False)  # First fix in the block
+    end_time = Column(DateTime(timezone=True), nullable=False)  # Last fix in the block
+    fix_count = Column(Integer, nullable=False)
+    path = Column(String, nullable=False)  # File name relative to LOCATION_ARCHIVE_DIR
+    file_offset = Column(BigInteger, nullable=False)  # Block position and size in the file
+    length = Column(Integer, nullable=False)
+
+
+Index('idx_location_archive_blocks_entity', LocationArchiveBlock.entity_type, LocationArchiveBlock.entity_id,
+      LocationArchiveBlock.start_time)
+Index('idx_location_archive_blocks_time', LocationArchiveBlock.start_time)
@@ -0,0 +1,122 @@
+import os
+import asyncio
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional, Tuple
+
+import orjson
+from starlette.concurrency import run_in_threadpool
+
+from app import archive, crud
+from app.sharding import shard_for
+
+
+# Fixes fetched per query; the next page is prefetched while the current one plays
+REPLAY_CHUNK_ROWS = int(os.getenv("REPLAY_CHUNK_ROWS", "500"))
+# Longest real wait between two events, so a bus parked for an hour doesn't stall the replay
+REPLAY_MAX_WAIT_SECONDS = float(os.getenv("REPLAY_MAX_WAIT_SECONDS", "5"))
+REPLAY_MAX_FPS = int(os.getenv("REPLAY_MAX_FPS", "30"))
+
+# Client reconnection delay sent at the start of every stream
+SSE_RETRY_MS = 3000
+
+
+def event_id(fix) -> str:
+    """SSE id of a fix: its keyset position, so a reconnect (Last-Event-ID) resumes right after it"""
+    return f"{fix.timestamp.isoformat()},{fix.id}"
+
+
+def parse_event_id(value: str) -> Optional[Tuple[datetime, int]]:
+    try:
+        timestamp, location_id = value.rsplit(",", 1)
+        return datetime.fromisoformat(timestamp), int(location_id)
+    except ValueError:
+        return None
+
+
+def seek_position(seek: datetime) -> Tuple[datetime, int]:
+    # Keyset position just before the first fix at ``seek``
+    return seek - timedelta(microseconds=1), 0
+
+
+def _fetch_chunk(entity_type: str, entity_id: str, after: Tuple[datetime, int], until: datetime):
+    # A fresh short-lived replica session per page: a slow replay must not hold a connection for the whole trip
+    with shard_for(entity_type, entity_id).ReadSessionLocal() as db:
+        rows = crud.get_entity_fixes_after(db, entity_type, entity_id, after, until, REPLAY_CHUNK_ROWS)
+        archived = archive.get_archived_fixes_after(db, entity_type, entity_id, after, until, REPLAY_CHUNK_ROWS)
+    if not archived:
+        return rows
+    # Archived days come first, but backfills can put table rows among them
+    return sorted([*archived, *rows], key=lambda fix: (fix.timestamp, fix.id))[:REPLAY_CHUNK_ROWS]
+
+
+async def iter_fixes(entity_type: str, entity_id: str, after: Tuple[datetime, int], until: datetime):
+    """Fixes in time order, one page at a time, with the next page already in flight"""
+    pending = asyncio.ensure_future(run_in_threadpool(_fetch_chunk, entity_type, entity_id, after, until))
+    try:
+        while True:
+            rows = await pending
+            if len(rows) == REPLAY_CHUNK_ROWS:
+                last = rows[-1]
+                pending = asyncio.ensure_future(
+                    run_in_threadpool(_fetch_chunk, entity_type, entity_id, (last.timestamp, last.id), until)
+                )
+            else:
+                pending = None
+            for row in rows:
+                yield row
+            if pending is None:
+                return
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+
+
+def sse_event(event: str, data: dict, id: Optional[str] = None) -> bytes:
+    lines = [f"id: {id}".encode()] if id is not None else []
+    lines += [f"event: {event}".encode(), b"data: " + orjson.dumps(data)]
+    return b"\n".join(lines) + b"\n\n"
+
+
+def position(entity_id: str, latitude: float, longitude: float, timestamp: datetime, interpolated: bool) -> dict:
+    return {"entity_id": entity_id, "latitude": latitude, "longitude": longitude, "timestamp": timestamp,
+            "interpolated": interpolated}
+
+
+async def replay_events(entity_type: str, entity_id: str, after: Tuple[datetime, int], until: datetime,
+                        speed: float, fps: float) -> AsyncIterator[bytes]:
+    """Server-sent events replaying an entity's fixes with their original spacing divided by ``speed``.
+
+    With ``fps`` > 0, interpolated positions are emitted between fixes at that
+    frame rate. Waits are scheduled against the loop clock so they don't drift,
+    and capped at REPLAY_MAX_WAIT_SECONDS.
+    """
+    loop = asyncio.get_running_loop()
+    yield f"retry: {SSE_RETRY_MS}\n\n".encode()
+
+    previous, deadline = None, loop.time()
+    count = 0
+    async for fix in iter_fixes(entity_type, entity_id, after, until):
+        if previous is not None:
+            span = (fix.timestamp - previous.timestamp).total_seconds()
+            wait = min(span / speed, REPLAY_MAX_WAIT_SECONDS)
+            frames = int(wait * fps) if span > 0 else 0
+            for frame in range(1, frames):
+                fraction = frame / frames
+                await asyncio.sleep(max(deadline + wait * fraction - loop.time(), 0))
+                yield sse_event("position", position(
+                    entity_id,
+                    previous.latitude + (fix.latitude - previous.latitude) * fraction,
+                    previous.longitude + (fix.longitude - previous.longitude) * fraction,
+                    previous.timestamp + timedelta(seconds=span * fraction),
+                    True,
+                ))
+            deadline += wait
+            await asyncio.sleep(max(deadline - loop.time(), 0))
+
+        yield sse_event("position", position(entity_id, fix.latitude, fix.longitude, fix.timestamp, False),
+                        id=event_id(fix))
+        previous, count = fix, count + 1
+        # After a stall (a slow page fetch), catch up by at most REPLAY_MAX_WAIT_SECONDS instead of bursting
+        deadline = max(deadline, loop.time() - REPLAY_MAX_WAIT_SECONDS)
+
+    yield sse_event("end", {"entity_id": entity_id, "fixes": count})
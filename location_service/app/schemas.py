@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import List, Literal, Optional
 
 
 class LocationBase(BaseModel):
@@ -31,4 +31,22 @@ class EntityLocationResponse(BaseModel):
     timestamp: datetime
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class EntityRef(BaseModel):
+    entity_type: Literal["student", "bus"]
+    entity_id: str
+
+
+class LatestLocationsBatchRequest(BaseModel):
+    entities: List[EntityRef]
+
+
+class EntityLookupError(EntityRef):
+    error: str
+
+
+class LatestLocationsBatchResponse(BaseModel):
+    locations: List[EntityLocationResponse]
+    errors: List[EntityLookupError]
@@ -0,0 +1,79 @@
+import os
+import hashlib
+import contextvars
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.database import Shard, shards, SHARD_PINS
+
+
+# Threads running per-shard queries of fleet-wide requests (scatter-gather), shared by all requests
+LOCATION_SCATTER_THREADS = int(os.getenv("LOCATION_SCATTER_THREADS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=LOCATION_SCATTER_THREADS, thread_name_prefix="shard-scatter")
+
+
+def entity_key(entity_type: str, entity_id: str) -> str:
+    return f"{entity_type}:{entity_id}"
+
+
+def _weight(shard_name: str, key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{shard_name}|{key}".encode(), digest_size=8).digest(), "big")
+
+
+def shard_for(entity_type: str, entity_id: str) -> Shard:
+    """Owning shard of an entity: its pin in the shard map, else rendezvous hashing.
+
+    With rendezvous hashing, adding a shard only moves the entities the new
+    shard wins (about 1/N of them), and removing one only moves its own.
+    """
+    key = entity_key(entity_type, entity_id)
+    pinned = SHARD_PINS.get(key)
+    if pinned:
+        return shards[pinned]
+    if len(shards) == 1:
+        return next(iter(shards.values()))
+    return max(shards.values(), key=lambda shard: _weight(shard.name, key))
+
+
+def group_by_shard(entities: Iterable[Tuple[str, str]]) -> Dict[str, List[Tuple[str, str]]]:
+    """(entity_type, entity_id) pairs grouped by owning shard name"""
+    groups = defaultdict(list)
+    for entity_type, entity_id in entities:
+        groups[shard_for(entity_type, entity_id).name].append((entity_type, entity_id))
+    return groups
+
+
+def scatter(fn: Callable[[Shard], object], targets: Optional[Iterable[Shard]] = None) -> list:
+    """``fn(shard)`` on every shard (or ``targets``) in parallel; results in shard order.
+
+    Tasks run in the caller's context, so their DB time still counts towards
+    the request's Server-Timing.
+    """
+    targets = list(shards.values() if targets is None else targets)
+    if len(targets) == 1:
+        return [fn(targets[0])]
+    futures = [_executor.submit(contextvars.copy_context().run, fn, shard) for shard in targets]
+    return [future.result() for future in futures]
+
+
+def scatter_read(fn: Callable, *args, targets: Optional[Iterable[Shard]] = None, **kwargs) -> list:
+    """``fn(db, *args, **kwargs)`` with a replica session of every shard, in parallel"""
+    def run(shard: Shard):
+        with shard.ReadSessionLocal() as db:
+            return fn(db, *args, **kwargs)
+    return scatter(run, targets)
+
+
+def format_version(versions: List[int]) -> str:
+    # One location version per shard, in shard order: "1234" unsharded, "1234.98.7701" with three shards
+    return ".".join(str(version) for version in versions)
+
+
+def parse_version(token: str) -> Optional[List[int]]:
+    try:
+        versions = [int(part) for part in token.split(".")]
+    except ValueError:
+        return None
+    return versions if len(versions) == len(shards) else None
@@ -0,0 +1,98 @@
+"""Compact binary batch upload of GPS fixes from tracker devices.
+
+Little-endian, fixed width:
+
+    header  16 bytes  magic b"GPS1", version (u8) = 1, flags (u8), fix count (u16), base time (i64, ms since epoch)
+    fix     12 bytes  time offset from the base (u32, ms), latitude (i32, 1e-7 deg), longitude (i32, 1e-7 deg)
+            +4 bytes  when flags & FLAG_MOTION: speed (u16, cm/s), heading (u16, 0.01 deg)
+
+12-16 bytes per fix instead of a JSON request each; the body is decoded in
+place with ``numpy.frombuffer``.
+"""
+import os
+import time
+import struct
+from datetime import timezone
+from typing import List
+
+import numpy as np
+
+
+# Most fixes per upload, and how far device clocks may be off: fixes older or in the future are refused
+LOCATION_UPLOAD_MAX_FIXES = int(os.getenv("LOCATION_UPLOAD_MAX_FIXES", "3600"))
+LOCATION_UPLOAD_MAX_AGE_SECONDS = int(os.getenv("LOCATION_UPLOAD_MAX_AGE_SECONDS", str(7 * 86400)))
+LOCATION_UPLOAD_MAX_AHEAD_SECONDS = int(os.getenv("LOCATION_UPLOAD_MAX_AHEAD_SECONDS", "300"))
+
+CONTENT_TYPE = "application/vnd.transport-scolaire.gps-batch"
+
+HEADER = struct.Struct("<4sBBHq")
+MAGIC = b"GPS1"
+VERSION = 1
+FLAG_MOTION = 0x01
+
+FIX_DTYPE = np.dtype([("offset_ms", "<u4"), ("lat", "<i4"), ("lon", "<i4")])
+MOTION_FIX_DTYPE = np.dtype([("offset_ms", "<u4"), ("lat", "<i4"), ("lon", "<i4"), ("speed", "<u2"), ("heading", "<u2")])
+
+COORDINATE_SCALE = 10_000_000
+
+
+class UploadError(ValueError):
+    """The body is not a valid batch"""
+
+
+def encode_batch(fixes: List[dict], base_time_ms: int = None) -> bytes:
+    """Reference encoder (device firmware, load tests): fixes are {timestamp_ms, latitude, longitude[, speed, heading]}"""
+    motion = bool(fixes) and "speed" in fixes[0]
+    base_time_ms = base_time_ms if base_time_ms is not None else min((f["timestamp_ms"] for f in fixes), default=0)
+    records = np.zeros(len(fixes), dtype=MOTION_FIX_DTYPE if motion else FIX_DTYPE)
+    records["offset_ms"] = [f["timestamp_ms"] - base_time_ms for f in fixes]
+    records["lat"] = np.round([f["latitude"] * COORDINATE_SCALE for f in fixes])
+    records["lon"] = np.round([f["longitude"] * COORDINATE_SCALE for f in fixes])
+    if motion:
+        records["speed"] = np.round([f["speed"] * 100 for f in fixes])
+        records["heading"] = np.round([(f["heading"] % 360) * 100 for f in fixes])
+    return HEADER.pack(MAGIC, VERSION, FLAG_MOTION if motion else 0, len(fixes), base_time_ms) + records.tobytes()
+
+
+def decode_batch(body: bytes, now: float = None) -> dict:
+    """Validated columns of a batch: timestamp_ms (int64), latitude, longitude and, if sent, speed and heading"""
+    if len(body) < HEADER.size:
+        raise UploadError("Body shorter than the header")
+    magic, version, flags, count, base_time_ms = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise UploadError(f"Expected a version {VERSION} GPS batch")
+    if count > LOCATION_UPLOAD_MAX_FIXES:
+        raise UploadError(f"At most {LOCATION_UPLOAD_MAX_FIXES} fixes per upload")
+
+    dtype = MOTION_FIX_DTYPE if flags & FLAG_MOTION else FIX_DTYPE
+    if len(body) != HEADER.size + count * dtype.itemsize:
+        raise UploadError(f"Body length does not match {count} fixes of {dtype.itemsize} bytes")
+    records = np.frombuffer(body, dtype=dtype, count=count, offset=HEADER.size)
+
+    timestamps_ms = base_time_ms + records["offset_ms"].astype(np.int64)
+    latitudes = records["lat"] / COORDINATE_SCALE
+    longitudes = records["lon"] / COORDINATE_SCALE
+    if (np.abs(latitudes) > 90).any() or (np.abs(longitudes) > 180).any():
+        raise UploadError("Coordinates out of range")
+
+    now_ms = (now if now is not None else time.time()) * 1000
+    if count and (timestamps_ms.min() < now_ms - LOCATION_UPLOAD_MAX_AGE_SECONDS * 1000
+                  or timestamps_ms.max() > now_ms + LOCATION_UPLOAD_MAX_AHEAD_SECONDS * 1000):
+        raise UploadError("Fix timestamps outside the accepted window; check the device clock")
+
+    columns = {"timestamp_ms": timestamps_ms, "latitude": latitudes, "longitude": longitudes}
+    if flags & FLAG_MOTION:
+        columns["speed"] = records["speed"] / 100.0
+        columns["heading"] = records["heading"] / 100.0
+    return columns
+
+
+def to_fixes(columns: dict) -> List[dict]:
+    """Rows for crud.create_locations"""
+    timestamps = columns["timestamp_ms"].astype("datetime64[ms]").astype(object)
+    names = [name for name in ("latitude", "longitude", "speed", "heading") if name in columns]
+    values = zip(*(columns[name].tolist() for name in names))
+    return [
+        {"timestamp": timestamp.replace(tzinfo=timezone.utc), **dict(zip(names, row))}
+        for timestamp, row in zip(timestamps, values)
+    ]
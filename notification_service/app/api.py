@@ -1,22 +1,82 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Optional
+from datetime import datetime
+import base64
+import os
+import json
+import time
+import logging
+import uuid
+import threading
 import requests
-from app import schemas, models
-from app.database import SessionLocal, engine
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from kafka import KafkaProducer
+from kafka.errors import KafkaError
+from app import schemas, models, crud, tracing
+from app.database import SessionLocal, ReadSessionLocal
 
-# Create the database tables automatically
-models.Base.metadata.create_all(bind=engine)
+# The schema is created by the migration step (python -m app.migrate), not on import
 
 app = FastAPI(title="Notification Service (Simplified)")
 
+logger = logging.getLogger(__name__)
+
 # -------------------------------------------------------------
 # 🔐 Auth Service Integration
 # -------------------------------------------------------------
-AUTH_BASE_URL = "http://172.30.80.11:31006/auth/"
+AUTH_BASE_URL = os.getenv("AUTH_BASE_URL", "http://172.30.80.11:31006/auth/")
 ADMIN_EMAIL = "admin@test.com"
 ADMIN_PASS = "password"
 
+# Successful user/role checks and the admin token are reused for this long
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+# Validated user/role pairs kept at most; the least recently used are evicted first
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+_auth_cache_lock = threading.Lock()
+_auth_token = {"value": None, "expires_at": 0.0}
+_validated_users = OrderedDict()  # (user_id, role) -> expiry timestamp, least recently used first
+
+
+def get_cached_auth_token() -> str:
+    """Admin token from the cache, logging in again only when it has expired."""
+    with _auth_cache_lock:
+        if _auth_token["value"] and _auth_token["expires_at"] > time.monotonic():
+            return _auth_token["value"]
+
+    token = get_auth_token()
+    with _auth_cache_lock:
+        _auth_token["value"] = token
+        _auth_token["expires_at"] = time.monotonic() + AUTH_CACHE_TTL_SECONDS
+    return token
+
+
+def validate_user_and_role_cached(user_id: str, role: str):
+    """
+    Same as validate_user_and_role, but a successful check is remembered for
+    AUTH_CACHE_TTL_SECONDS so repeated sends don't wait on the Auth Service.
+    Failures are never cached.
+    """
+    key = (str(user_id), role.lower())
+    with _auth_cache_lock:
+        expires_at = _validated_users.get(key)
+        if expires_at and expires_at > time.monotonic():
+            _validated_users.move_to_end(key)
+            return True
+        _validated_users.pop(key, None)
+
+    validate_user_and_role(user_id, role)
+
+    with _auth_cache_lock:
+        _validated_users[key] = time.monotonic() + AUTH_CACHE_TTL_SECONDS
+        _validated_users.move_to_end(key)
+        while len(_validated_users) > AUTH_CACHE_MAX_ENTRIES:
+            _validated_users.popitem(last=False)
+    return True
+
+
 def get_auth_token() -> str:
     """Helper to get the admin token from the auth service."""
     url = AUTH_BASE_URL + "login"
@@ -50,7 +110,7 @@ def validate_user_and_role(user_id: str, role: str):
         raise HTTPException(status_code=400, detail="User ID must be a valid integer")
 
     # 2. Get Token
-    token = get_auth_token()
+    token = get_cached_auth_token()
 
     # 3. Check User
     url = AUTH_BASE_URL + f"user/{uid_int}"
@@ -91,47 +151,224 @@ def get_db():
     finally:
         db.close()
 
+
+def get_read_db():
+    """Session on the read replica (DATABASE_READ_URL) for read-only endpoints; may lag the primary slightly"""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# -------------------------------------------------------------
+# 📨 Kafka Producer
+# -------------------------------------------------------------
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092").split(',')
+KAFKA_NOTIFICATIONS_TOPIC = os.getenv("KAFKA_NOTIFICATIONS_TOPIC", "eta_notifications")
+KAFKA_URGENT_TOPIC = os.getenv("KAFKA_URGENT_TOPIC", "urgent_notifications")
+# Recipients per broadcast message; 500 is the FCM multicast limit
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+
+_producer = None
+_producer_lock = threading.Lock()
+# Errbacks run on the producer's sender thread, so the status update is handed to this thread instead
+_failure_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notification-failed")
+
+
+def get_producer() -> KafkaProducer:
+    """Shared batching producer, created on first use so the API starts without Kafka."""
+    global _producer
+    with _producer_lock:
+        if _producer is None:
+            _producer = KafkaProducer(
+                bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+                key_serializer=lambda k: k.encode('utf-8'),
+                value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+                acks=1,
+                linger_ms=int(os.getenv("KAFKA_PRODUCER_LINGER_MS", "10")),
+                batch_size=int(os.getenv("KAFKA_PRODUCER_BATCH_SIZE", "65536")),
+                compression_type='gzip',
+                max_block_ms=1000
+            )
+        return _producer
+
+
+def mark_notification_failed(notification_id: int, error: Exception):
+    """Producer errback (run on _failure_pool): the message never reached Kafka, so the worker won't update it."""
+    logger.error(f"Failed to enqueue notification {notification_id}: {error}")
+    db = SessionLocal()
+    try:
+        crud.update_notification_status(db=db, notification_id=notification_id, status="failed")
+    finally:
+        db.close()
+
+
+@app.on_event("shutdown")
+def flush_producer():
+    if _producer is not None:
+        _producer.flush(timeout=5)
+        _producer.close(timeout=5)
+    # Let failures reported by the last sends reach the database
+    _failure_pool.shutdown(wait=True)
+
 # -------------------------------------------------------------
 # 🚀 Endpoints
 # -------------------------------------------------------------
 
-@app.post("/notifications/send", response_model=schemas.NotificationResponse)
+@app.post("/notifications/send", response_model=schemas.NotificationQueuedResponse, status_code=status.HTTP_202_ACCEPTED)
 def send_notification(
     notification: schemas.NotificationCreate, 
+    request: Request,
     db: Session = Depends(get_db)
 ):
-    # Validate User and Role with External Service
-    validate_user_and_role(notification.user_id, notification.entity_type)
+    # Validate User and Role with External Service (cached)
+    validate_user_and_role_cached(notification.user_id, notification.entity_type)
 
-    # If validation passes, create record
+    # Record the notification; its id is the tracking id and the worker updates its status
     db_notification = models.Notification(
         user_id=notification.user_id,
         entity_type=notification.entity_type,
         title=notification.title,
         body=notification.body,
-        status="sent" 
+        status="queued"
     )
     
     db.add(db_notification)
     db.commit()
-    db.refresh(db_notification)
+    notification_id = db_notification.id
+
+    message = {
+        "notification_id": notification_id,
+        "idempotency_key": f"notification-{notification_id}",
+        "user_id": notification.user_id,
+        "entity_type": notification.entity_type,
+        "notification_type": notification.notification_type,
+        "priority": notification.priority,
+        "title": notification.title,
+        "body": notification.body,
+        "data": notification.data or {}
+    }
+    topic = KAFKA_URGENT_TOPIC if notification.priority == "urgent" else KAFKA_NOTIFICATIONS_TOPIC
+    # Continue the caller's trace (or start one) so the worker and the device can be correlated
+    traceparent = tracing.child_traceparent(request.headers.get(tracing.TRACEPARENT_HEADER))
 
+    # Hand the message to the batching producer; the send itself happens in the background
+    try:
+        future = get_producer().send(topic, key=notification.user_id, value=message,
+                                     headers=tracing.kafka_headers(traceparent))
+        future.add_errback(lambda e: _failure_pool.submit(mark_notification_failed, notification_id, e))
+    except KafkaError as e:
+        crud.update_notification_status(db=db, notification_id=notification_id, status="failed")
+        raise HTTPException(status_code=503, detail=f"Notification queue unavailable: {e}")
+
+    return {"tracking_id": notification_id, "status": "queued"}
+
+@app.post("/notifications/broadcast", response_model=schemas.BroadcastQueuedResponse, status_code=status.HTTP_202_ACCEPTED)
+def broadcast_notification(
+    broadcast: schemas.BroadcastCreate,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    notification_type = crud.get_notification_type_by_name(db=db, name=broadcast.notification_type)
+    if not notification_type or not notification_type.is_active:
+        raise HTTPException(status_code=404, detail=f"Notification type '{broadcast.notification_type}' not found or inactive")
+
+    broadcast_id = str(uuid.uuid4())
+    topic = KAFKA_URGENT_TOPIC if broadcast.priority == "urgent" else KAFKA_NOTIFICATIONS_TOPIC
+    producer = get_producer()
+    headers = tracing.kafka_headers(tracing.child_traceparent(request.headers.get(tracing.TRACEPARENT_HEADER)))
+
+    # Stream subscribers chunk by chunk; each chunk becomes one multicast message for the worker
+    recipients = 0
+    chunks = 0
+    try:
+        for user_ids in crud.iter_subscribed_user_ids(db=db, notification_type_id=notification_type.id, chunk_size=BROADCAST_CHUNK_SIZE):
+            producer.send(topic, key=f"{broadcast_id}:{chunks}", value={
+                "broadcast_id": broadcast_id,
+                "idempotency_key": f"broadcast-{broadcast_id}-{chunks}",
+                "user_ids": user_ids,
+                "notification_type": broadcast.notification_type,
+                "priority": broadcast.priority,
+                "title": broadcast.title,
+                "body": broadcast.body,
+                "data": broadcast.data or {}
+            }, headers=headers)
+            recipients += len(user_ids)
+            chunks += 1
+    except KafkaError as e:
+        raise HTTPException(status_code=503, detail=f"Notification queue unavailable after {chunks} chunks: {e}")
+
+    return {
+        "broadcast_id": broadcast_id,
+        "notification_type": broadcast.notification_type,
+        "recipients": recipients,
+        "chunks": chunks,
+        "status": "queued"
+    }
+
+@app.get("/notifications/status/{tracking_id}", response_model=schemas.NotificationResponse)
+def get_notification_status(
+    tracking_id: int,
+    db: Session = Depends(get_db)
+):
+    db_notification = db.query(models.Notification).filter(models.Notification.id == tracking_id).first()
+    if not db_notification:
+        raise HTTPException(status_code=404, detail=f"Notification {tracking_id} not found")
     return db_notification
 
-@app.get("/notifications/history/{entity_type}/{user_id}", response_model=List[schemas.NotificationResponse])
+def encode_cursor(notification: models.Notification) -> str:
+    raw = f"{notification.created_at.isoformat()}|{notification.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, notification_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(notification_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/notifications/history/{entity_type}/{user_id}", response_model=schemas.NotificationHistoryPage)
 def get_notification_history(
     entity_type: str, 
     user_id: str, 
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    include_counts: Optional[bool] = None,
+    db: Session = Depends(get_read_db)
+):
+    validate_user_and_role_cached(user_id, entity_type)
+
+    before = decode_cursor(cursor) if cursor else None
+    notifications = crud.get_notification_page(
+        db=db, user_id=user_id, entity_type=entity_type, limit=limit, before=before, since=since
+    )
+
+    page = {
+        "items": notifications,
+        "next_cursor": encode_cursor(notifications[-1]) if len(notifications) == limit else None
+    }
+    # Counting walks the user's whole history, so by default only the first page carries the counts
+    if include_counts is None:
+        include_counts = before is None
+    if include_counts:
+        page["total"], page["unread"] = crud.count_notifications(db=db, user_id=user_id, entity_type=entity_type)
+
+    return page
+
+@app.post("/notifications/history/{entity_type}/{user_id}/read", response_model=schemas.MarkReadResponse)
+def mark_notification_history_read(
+    entity_type: str,
+    user_id: str,
+    request: schemas.MarkReadRequest,
     db: Session = Depends(get_db)
 ):
-    validate_user_and_role(user_id, entity_type)
+    validate_user_and_role_cached(user_id, entity_type)
 
-    notifications = db.query(models.Notification).filter(
-        models.Notification.user_id == user_id,
-        models.Notification.entity_type == entity_type
-    ).order_by(models.Notification.created_at.desc()).all()
-    
-    return notifications
+    updated = crud.mark_notifications_read(db=db, user_id=user_id, entity_type=entity_type, until=request.until)
+    return {"updated": updated}
 
 @app.get("/")
 def api_overview():
@@ -143,18 +380,44 @@ def api_overview():
             "send_notification": {
                 "method": "POST",
                 "path": "/notifications/send",
-                "description": "Validates user via Auth Service, then records notification.",
+                "description": "Validates user via Auth Service (cached), records the notification and queues it on Kafka. Returns 202 with a tracking id.",
                 "body_format": {
                     "user_id": "string (numeric)",
                     "entity_type": "string ('Student', 'Driver', etc.)",
                     "title": "string",
-                    "body": "string"
+                    "body": "string",
+                    "notification_type": "string (optional, default 'general')",
+                    "priority": "string (optional, 'urgent' or 'normal')",
+                    "data": "object (optional)"
                 }
             },
+            "broadcast": {
+                "method": "POST",
+                "path": "/notifications/broadcast",
+                "description": "Queues a notification for every subscriber of a notification type, fanned out in multicast chunks.",
+                "body_format": {
+                    "notification_type": "string (name of an active notification type)",
+                    "title": "string",
+                    "body": "string",
+                    "priority": "string (optional, 'urgent' or 'normal')",
+                    "data": "object (optional)"
+                }
+            },
+            "get_status": {
+                "method": "GET",
+                "path": "/notifications/status/{tracking_id}",
+                "description": "Delivery status of a queued notification (queued, retrying, sent, failed, ...)."
+            },
             "get_history": {
                 "method": "GET",
                 "path": "/notifications/history/{entity_type}/{user_id}",
-                "description": "Fetches notification history filtered by entity type and user ID."
+                "description": "Fetches one page of notification history (newest first) with total/unread counts. Query: limit, cursor (next_cursor of the previous page), since (only newer entries)."
+            },
+            "mark_read": {
+                "method": "POST",
+                "path": "/notifications/history/{entity_type}/{user_id}/read",
+                "description": "Marks the user's notifications as read, optionally only those created until a given time.",
+                "body_format": {"until": "datetime (optional)"}
             }
         },
         "documentation": "/docs"
@@ -1,7 +1,9 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from app.models import NotificationHistory, NotificationType, NotificationSubscription
-from typing import List, Optional
+from sqlalchemy import and_, insert, update, select, func, tuple_, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.models import Notification, NotificationHistory, NotificationType, NotificationSubscription, NotificationDelivery
+from datetime import datetime
+from typing import Iterator, List, Optional
 
 
 def create_notification_history(db: Session, user_id: str, message: str, status: str):
@@ -12,14 +14,86 @@ def create_notification_history(db: Session, user_id: str, message: str, status:
         status=status
     )
 
-    # Add to database session and commit
+    # Add to database session and commit (no refresh: callers don't read the row back)
     db.add(db_notification)
     db.commit()
-    db.refresh(db_notification)
 
     return db_notification
 
 
+def bulk_create_notification_history(db: Session, records: List[dict], status_updates: Optional[dict] = None):
+    # Insert many history records in a single statement, apply the matching
+    # notification status changes ({notification_id: status}) and commit once
+    if not records and not status_updates:
+        return 0
+
+    if records:
+        db.execute(insert(NotificationHistory), records)
+    if status_updates:
+        # Core executemany keyed on id only: the worker doesn't know created_at, the other half of the key
+        db.execute(
+            update(Notification.__table__).where(
+                Notification.__table__.c.id == bindparam("notification_id")
+            ).values(status=bindparam("new_status")),
+            [
+                {"notification_id": notification_id, "new_status": status}
+                for notification_id, status in status_updates.items()
+            ]
+        )
+    db.commit()
+
+    return len(records)
+
+
+def get_notification_page(db: Session, user_id: str, entity_type: str, limit: int = 50,
+                          before: Optional[tuple] = None, since: Optional[datetime] = None):
+    # Keyset pagination on (created_at, id) DESC: `before` is the last row of the previous page
+    query = db.query(Notification).filter(
+        Notification.user_id == user_id,
+        Notification.entity_type == entity_type
+    )
+
+    if before is not None:
+        # The plain created_at bound lets the planner skip newer partitions; the row comparison breaks ties
+        query = query.filter(
+            Notification.created_at <= before[0],
+            tuple_(Notification.created_at, Notification.id) < tuple_(*before)
+        )
+    if since is not None:
+        query = query.filter(Notification.created_at > since)
+
+    return query.order_by(Notification.created_at.desc(), Notification.id.desc()).limit(limit).all()
+
+
+def count_notifications(db: Session, user_id: str, entity_type: str):
+    # The total walks the user's history index range; the unread count uses the partial index on unread rows
+    user_filter = (Notification.user_id == user_id, Notification.entity_type == entity_type)
+    total = db.query(func.count(Notification.id)).filter(*user_filter).scalar()
+    unread = db.query(func.count(Notification.id)).filter(*user_filter, Notification.is_read == False).scalar()
+    return total, unread
+
+
+def mark_notifications_read(db: Session, user_id: str, entity_type: str, until: Optional[datetime] = None) -> int:
+    query = db.query(Notification).filter(
+        Notification.user_id == user_id,
+        Notification.entity_type == entity_type,
+        Notification.is_read == False
+    )
+    if until is not None:
+        query = query.filter(Notification.created_at <= until)
+
+    updated = query.update({"is_read": True}, synchronize_session=False)
+    db.commit()
+    return updated
+
+
+def update_notification_status(db: Session, notification_id: int, status: str):
+    db.query(Notification).filter(
+        Notification.id == notification_id
+    ).update({"status": status}, synchronize_session=False)
+    db.commit()
+
+
 def get_notification_history_by_user_id(db: Session, user_id: str):
     # Query for all notification history records for the given user_id
     return db.query(NotificationHistory).filter(
@@ -129,6 +203,17 @@ def get_users_subscribed_to_type(db: Session, notification_type_id: int):
     ).all()
 
 
+def iter_subscribed_user_ids(db: Session, notification_type_id: int, chunk_size: int = 500) -> Iterator[List[str]]:
+    # Stream subscriber ids in chunks through a server-side cursor instead of loading them all
+    statement = select(NotificationSubscription.user_id).where(
+        NotificationSubscription.notification_type_id == notification_type_id,
+        NotificationSubscription.is_subscribed == True
+    ).order_by(NotificationSubscription.id).execution_options(yield_per=chunk_size)
+
+    for chunk in db.execute(statement).scalars().partitions():
+        yield list(chunk)
+
+
 def create_or_update_notification_subscription(db: Session, user_id: str, notification_type_id: int, is_subscribed: bool = True):
     # Check if subscription already exists
     existing_subscription = get_user_subscription_by_type(db, user_id, notification_type_id)
@@ -157,4 +242,32 @@ def subscribe_user_to_notification_type(db: Session, user_id: str, notification_
 
 
 def unsubscribe_user_from_notification_type(db: Session, user_id: str, notification_type_id: int):
-    return create_or_update_notification_subscription(db, user_id, notification_type_id, is_subscribed=False)
\ No newline at end of file
+    return create_or_update_notification_subscription(db, user_id, notification_type_id, is_subscribed=False)
+
+
+# CRUD operations for delivery idempotency keys
+def claim_delivery_keys(db: Session, idempotency_keys: List[str]) -> set:
+    # Insert the keys no other worker has claimed yet, in one statement; the returned keys are ours to deliver.
+    # Not committed here: the claims commit with the batch's history, see bulk_create_notification_history
+    statement = pg_insert(NotificationDelivery).values(
+        [{"idempotency_key": key} for key in idempotency_keys]
+    ).on_conflict_do_nothing(
+        index_elements=[NotificationDelivery.idempotency_key]
+    ).returning(NotificationDelivery.idempotency_key)
+
+    return set(db.execute(statement).scalars())
+
+
+def release_delivery_key(db: Session, idempotency_key: str):
+    # Forget a claim so a later retry or replay of the same message can deliver it; committed with the batch
+    db.query(NotificationDelivery).filter(
+        NotificationDelivery.idempotency_key == idempotency_key
+    ).delete(synchronize_session=False)
+
+
+def purge_delivery_keys(db: Session, older_than: datetime) -> int:
+    deleted = db.query(NotificationDelivery).filter(
+        NotificationDelivery.created_at < older_than
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
@@ -1,14 +1,74 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
 
+# notifications and notification_history are range-partitioned by month on their
+# timestamp column (see app/partitions.py); Postgres requires the partition key
+# to be part of the primary key, hence the composite (id, timestamp) keys.
+
 class Notification(Base):
     __tablename__ = "notifications"
 
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)    
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    user_id = Column(String, index=True)
     entity_type = Column(String, index=True)
     title = Column(String)
     body = Column(Text)
     status = Column(String, default="pending")
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    is_read = Column(Boolean, default=False, server_default="false", nullable=False)
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+
+    __table_args__ = (
+        # Serves the keyset-paginated history: equality on user/entity, then (created_at, id) DESC
+        Index("ix_notifications_user_entity_created", "user_id", "entity_type", created_at.desc(), id.desc()),
+        # Unread counts only touch the few unread rows of a user, not their whole history
+        Index("ix_notifications_user_entity_unread", "user_id", "entity_type", postgresql_where=is_read == False),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+
+class NotificationHistory(Base):
+    __tablename__ = "notification_history"
+
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    user_id = Column(String, index=True, nullable=False)
+    message = Column(Text, nullable=False)
+    status = Column(String, nullable=False)  # 'sent', 'failed', 'skipped', 'pending'
+    timestamp = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+
+    __table_args__ = (
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+
+class NotificationType(Base):
+    __tablename__ = "notification_types"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, index=True, nullable=False)
+    description = Column(Text)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class NotificationSubscription(Base):
+    __tablename__ = "notification_subscriptions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True, nullable=False)
+    notification_type_id = Column(Integer, ForeignKey("notification_types.id"), nullable=False)
+    is_subscribed = Column(Boolean, default=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    notification_type = relationship("NotificationType")
+
+
+class NotificationDelivery(Base):
+    __tablename__ = "notification_deliveries"
+
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column(String(128), unique=True, nullable=False)  # unique index backs the worker's dedup check
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
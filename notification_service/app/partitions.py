@@ -0,0 +1,217 @@
+import os
+import re
+import gzip
+import time
+import threading
+import json
+import logging
+import argparse
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# Partitioned tables and their partition key (monthly RANGE partitions)
+PARTITIONED_TABLES = {
+    "notifications": "created_at",
+    "notification_history": "timestamp",
+}
+
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "365"))
+NOTIFICATION_ARCHIVE_DIR = os.getenv("NOTIFICATION_ARCHIVE_DIR", "./archive")
+PARTITION_MONTHS_AHEAD = int(os.getenv("NOTIFICATION_PARTITION_MONTHS_AHEAD", "2"))
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("NOTIFICATION_PARTITION_MAINTENANCE_INTERVAL_SECONDS", "3600"))
+
+# Arbitrary constant so only one replica runs maintenance at a time
+MAINTENANCE_LOCK_ID = 74021
+
+PARTITION_NAME = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table: str, start: date) -> str:
+    return f"{table}_p{start:%Y%m}"
+
+
+def move_default_rows(conn, table: str, key: str) -> List[str]:
+    """Give every month found in the default partition its own partition and move the rows there.
+
+    Rows land in the default partition when no partition covers their month
+    (back-dated rows, maintenance not run in time). Left there they would never
+    be archived, and Postgres refuses to create a partition for a month the
+    default partition holds rows of.
+    """
+    months = conn.execute(text(
+        f"SELECT DISTINCT date_trunc('month', {key})::date FROM {table}_default WHERE {key} IS NOT NULL"
+    )).scalars().all()
+
+    created = []
+    for start in sorted(months):
+        name = partition_name(table, start)
+        bounds = {"start": start, "end": add_months(start, 1)}
+        conn.execute(text(
+            f"CREATE TEMP TABLE moved_rows AS SELECT * FROM {table}_default WHERE {key} >= :start AND {key} < :end"
+        ), bounds)
+        conn.execute(text(f"DELETE FROM {table}_default WHERE {key} >= :start AND {key} < :end"), bounds)
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{bounds['start'].isoformat()}') TO ('{bounds['end'].isoformat()}')"
+        ))
+        moved = conn.execute(text(f"INSERT INTO {table} SELECT * FROM moved_rows")).rowcount
+        conn.execute(text("DROP TABLE moved_rows"))
+        logger.info(f"Moved {moved} rows from {table}_default to {name}")
+        created.append(name)
+    return created
+
+
+def ensure_partitions(engine: Engine, months_ahead: int = PARTITION_MONTHS_AHEAD, today: date = None) -> List[str]:
+    """Create this month's and the next ``months_ahead`` monthly partitions, plus a default partition.
+
+    Rows found in the default partition are moved to partitions of their own
+    first, so it stays empty.
+    """
+    if engine.dialect.name != "postgresql":
+        return []
+
+    today = today or datetime.now(timezone.utc).date()
+    created = []
+
+    with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+            created += move_default_rows(conn, table, PARTITIONED_TABLES[table])
+
+            for offset in range(0, months_ahead + 1):
+                start = add_months(month_start(today), offset)
+                end = add_months(start, 1)
+                name = partition_name(table, start)
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                ))
+                created.append(name)
+
+    return created
+
+
+def list_partitions(conn, table: str) -> List[Tuple[str, date]]:
+    """Monthly partitions of ``table`` as (name, first day of the month), oldest first"""
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :table"
+    ), {"table": table}).scalars().all()
+
+    partitions = []
+    for name in rows:
+        match = PARTITION_NAME.search(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def export_partition(engine: Engine, name: str, archive_dir: str) -> str:
+    """Stream a partition to gzip-compressed NDJSON with a server-side cursor; returns the file path"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.ndjson.gz")
+    tmp_path = path + ".tmp"
+
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=5000).execute(text(f"SELECT * FROM {name}"))
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as out:
+            for row in result.mappings():
+                out.write(json.dumps(dict(row), default=str) + "\n")
+
+    # Only a complete export gets the final name; the partition is dropped after this returns
+    os.replace(tmp_path, path)
+    return path
+
+
+def archive_expired_partitions(engine: Engine, retention_days: int = NOTIFICATION_RETENTION_DAYS,
+                               archive_dir: str = NOTIFICATION_ARCHIVE_DIR, today: date = None) -> List[str]:
+    """Export, detach and drop every monthly partition that ended before the retention cutoff"""
+    today = today or datetime.now(timezone.utc).date()
+    cutoff = today - timedelta(days=retention_days)
+    archived = []
+
+    with engine.connect() as conn:
+        expired = [
+            (table, name)
+            for table in PARTITIONED_TABLES
+            for name, start in list_partitions(conn, table)
+            if add_months(start, 1) <= cutoff
+        ]
+
+    for table, name in expired:
+        path = export_partition(engine, name, archive_dir)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+        logger.info(f"Archived partition {name} to {path} and dropped it")
+        archived.append(name)
+
+    return archived
+
+
+def run_maintenance(engine: Engine) -> bool:
+    """Create upcoming partitions and archive expired ones; skipped if another replica holds the lock"""
+    if engine.dialect.name != "postgresql":
+        return False
+
+    with engine.connect() as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": MAINTENANCE_LOCK_ID}).scalar():
+            logger.info("Partition maintenance already running elsewhere, skipping")
+            return False
+
+        try:
+            ensure_partitions(engine)
+            archive_expired_partitions(engine)
+            return True
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+
+
+def start_maintenance_thread(engine: Engine, interval_seconds: int = PARTITION_MAINTENANCE_INTERVAL_SECONDS) -> threading.Thread:
+    """Run partition maintenance now and then every ``interval_seconds`` in a daemon thread"""
+    def loop():
+        while True:
+            try:
+                run_maintenance(engine)
+            except Exception as e:
+                logger.error(f"Partition maintenance failed: {e}")
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=loop, name="partition-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    from app.database import engine
+
+    parser = argparse.ArgumentParser(description="Notification table partition maintenance")
+    parser.add_argument("--ensure-only", action="store_true", help="Only create upcoming partitions, archive nothing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.ensure_only:
+        ensure_partitions(engine)
+    else:
+        run_maintenance(engine)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Dict, List
 from datetime import datetime
 
 class NotificationCreate(BaseModel):
@@ -7,6 +7,27 @@ class NotificationCreate(BaseModel):
     entity_type: str 
     title: str
     body: str
+    notification_type: str = "general"
+    priority: str = "normal"
+    data: Optional[Dict[str, str]] = None
+
+class BroadcastCreate(BaseModel):
+    notification_type: str
+    title: str
+    body: str
+    priority: str = "normal"
+    data: Optional[Dict[str, str]] = None
+
+class BroadcastQueuedResponse(BaseModel):
+    broadcast_id: str
+    notification_type: str
+    recipients: int
+    chunks: int
+    status: str
+
+class NotificationQueuedResponse(BaseModel):
+    tracking_id: int
+    status: str
 
 class NotificationResponse(BaseModel):
     id: int
@@ -15,7 +36,20 @@ class NotificationResponse(BaseModel):
     title: str
     body: str
     status: str
+    is_read: bool = False
     created_at: datetime
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class NotificationHistoryPage(BaseModel):
+    items: List[NotificationResponse]
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    unread: Optional[int] = None
+
+class MarkReadRequest(BaseModel):
+    until: Optional[datetime] = None
+
+class MarkReadResponse(BaseModel):
+    updated: int
\ No newline at end of file
@@ -0,0 +1,44 @@
+import re
+import secrets
+from typing import List, Optional, Tuple
+
+
+# W3C Trace Context (https://www.w3.org/TR/trace-context/), carried as an HTTP
+# header by callers, as a Kafka record header between the API and the worker,
+# and in the FCM data payload so the device can report it back
+TRACEPARENT_HEADER = "traceparent"
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+def parse_traceparent(value) -> Optional[Tuple[str, str]]:
+    """(trace id, parent span id) of a valid traceparent, else None"""
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "ignore")
+    match = _TRACEPARENT.match((value or "").strip().lower())
+    if not match or match.group(1) == "0" * 32:
+        return None
+    return match.group(1), match.group(2)
+
+
+def child_traceparent(parent=None) -> str:
+    """A new span in the caller's trace, or the root span of a new trace"""
+    parsed = parse_traceparent(parent)
+    trace_id = parsed[0] if parsed else secrets.token_hex(16)
+    return f"00-{trace_id}-{secrets.token_hex(8)}-01"
+
+
+def trace_id_of(traceparent) -> Optional[str]:
+    parsed = parse_traceparent(traceparent)
+    return parsed[0] if parsed else None
+
+
+def from_kafka_headers(headers) -> Optional[str]:
+    for key, value in headers or ():
+        if key.lower() == TRACEPARENT_HEADER:
+            return value.decode("ascii", "ignore") if isinstance(value, bytes) else value
+    return None
+
+
+def kafka_headers(traceparent: str) -> List[Tuple[str, bytes]]:
+    return [(TRACEPARENT_HEADER, traceparent.encode("ascii"))]
@@ -1,10 +1,13 @@
 #!/bin/bash
+# The schema must exist already: run "python -m app.migrate" once per deployment (docker-compose does)
+
 # Start the API in the background
 echo "Starting Notification Service API..."
 python -m uvicorn app.api:app --host 0.0.0.0 --port 8000 &
 
-# Wait a bit for the API to start
-sleep 5
+# Start the retry-tier consumer in the background
+echo "Starting Kafka retry consumer..."
+python worker/retry_consumer.py &
 
 # Start the Kafka consumer in the foreground
 echo "Starting Kafka consumer..."
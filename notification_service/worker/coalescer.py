@@ -0,0 +1,145 @@
+import os
+import time
+from collections import OrderedDict, deque, Counter
+from typing import Dict, List, Optional, Tuple
+
+
+# Hold window for coalescable types; only the newest message per (user, type) is delivered
+COALESCE_WINDOW_SECONDS = float(os.getenv("NOTIFICATION_COALESCE_WINDOW_SECONDS", "5"))
+COALESCE_TYPES = {t.strip() for t in os.getenv("NOTIFICATION_COALESCE_TYPES", "eta_update").split(",") if t.strip()}
+# Max pushes delivered to one recipient per rolling minute (0 disables the limit)
+RATE_LIMIT_PER_MINUTE = int(os.getenv("NOTIFICATION_RATE_LIMIT_PER_MINUTE", "6"))
+
+
+def recipient_of(payload: dict) -> Optional[str]:
+    """The identifier the message is addressed to, before any student -> parent lookup"""
+    user_id = payload.get('user_id') or payload.get('student_id') or payload.get('parent_id')
+    return str(user_id) if user_id else None
+
+
+class PendingNotification:
+    """Newest message held for one (recipient, notification_type)"""
+
+    __slots__ = ("payload", "idempotency_key", "due_at", "offsets", "merged")
+
+    def __init__(self, payload: dict, idempotency_key: str, due_at: float):
+        self.payload = payload
+        self.idempotency_key = idempotency_key
+        self.due_at = due_at
+        self.offsets = {}  # TopicPartition -> lowest offset folded into this entry
+        self.merged = 0
+
+    def track(self, tp, offset: int):
+        if tp is not None and (tp not in self.offsets or offset < self.offsets[tp]):
+            self.offsets[tp] = offset
+
+
+class Coalescer:
+    """Holds high-frequency notifications briefly and keeps only the newest per key.
+
+    Entries are due ``window`` seconds after the *first* message for their key, so
+    a steady stream of updates is still delivered once per window. All entries
+    share the same window, so insertion order is due order and ``pop_due`` only
+    looks at the front of the queue.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW_SECONDS, types=None):
+        self.window = window
+        self.types = COALESCE_TYPES if types is None else set(types)
+        self._pending: "OrderedDict[Tuple[str, str], PendingNotification]" = OrderedDict()
+        self.suppressed = Counter()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def accepts(self, payload: dict) -> bool:
+        return (
+            self.window > 0
+            and payload.get('notification_type', 'eta_update') in self.types
+            and recipient_of(payload) is not None
+        )
+
+    def offer(self, payload: dict, idempotency_key: str, tp=None, offset: int = None,
+              now: Optional[float] = None) -> Optional[PendingNotification]:
+        """Hold a message; returns the entry it superseded (to be recorded as coalesced), if any"""
+        now = time.monotonic() if now is None else now
+        key = (recipient_of(payload), payload.get('notification_type', 'eta_update'))
+
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = PendingNotification(payload, idempotency_key, now + self.window)
+            entry.track(tp, offset)
+            self._pending[key] = entry
+            return None
+
+        if entry.idempotency_key == idempotency_key:
+            # Same record seen again (batch rewound after a failed flush)
+            entry.track(tp, offset)
+            return None
+
+        superseded = PendingNotification(entry.payload, entry.idempotency_key, entry.due_at)
+        entry.payload = payload
+        entry.idempotency_key = idempotency_key
+        entry.merged += 1
+        entry.track(tp, offset)
+        self.suppressed["coalesced"] += 1
+        return superseded
+
+    def pop_due(self, now: Optional[float] = None) -> List[PendingNotification]:
+        """Remove and return every entry whose window has elapsed"""
+        now = time.monotonic() if now is None else now
+        due = []
+        while self._pending:
+            key, entry = next(iter(self._pending.items()))
+            if entry.due_at > now:
+                break
+            self._pending.popitem(last=False)
+            due.append(entry)
+        return due
+
+    def held_offsets(self) -> Dict:
+        """Lowest held offset per partition; offsets at or after it must not be committed yet"""
+        floors = {}
+        for entry in self._pending.values():
+            for tp, offset in entry.offsets.items():
+                if tp not in floors or offset < floors[tp]:
+                    floors[tp] = offset
+        return floors
+
+
+class RateLimiter:
+    """Per-recipient rolling one-minute push budget"""
+
+    def __init__(self, per_minute: int = RATE_LIMIT_PER_MINUTE, period: float = 60.0):
+        self.per_minute = per_minute
+        self.period = period
+        self._sent: Dict[str, deque] = {}
+        self._last_sweep = time.monotonic()
+        self.suppressed = Counter()
+
+    def allow(self, recipient: Optional[str], now: Optional[float] = None) -> bool:
+        """Consume one push from the recipient's budget; False means it must be suppressed"""
+        if self.per_minute <= 0 or recipient is None:
+            return True
+
+        now = time.monotonic() if now is None else now
+        sent = self._sent.setdefault(recipient, deque())
+        while sent and sent[0] <= now - self.period:
+            sent.popleft()
+
+        if len(sent) >= self.per_minute:
+            self.suppressed["rate_limited"] += 1
+            return False
+
+        sent.append(now)
+        self._sweep(now)
+        return True
+
+    def _sweep(self, now: float):
+        """Forget idle recipients so memory tracks active users only"""
+        if now - self._last_sweep < self.period:
+            return
+        self._last_sweep = now
+
+        for recipient in [r for r, sent in self._sent.items() if not sent or sent[-1] <= now - self.period]:
+            del self._sent[recipient]
@@ -1,25 +1,56 @@
 import os
 import sys
-import json
+import time
 import httpx
+import msgspec
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from kafka import KafkaConsumer
+from kafka.structs import OffsetAndMetadata
 from sqlalchemy.orm import Session
 
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.database import SessionLocal, engine
-from app import models, crud
+from app import crud, partitions, tracing
+from worker import metrics
+from worker.history_buffer import HistoryBuffer
+from worker.retry import RetryScheduler, RetryableNotificationError, create_producer, unwrap_envelope, is_retry_topic
+from worker.schema import DecodeTimer, decode_value
+from worker.dedup import DedupStore, idempotency_key_for
+from worker.coalescer import Coalescer, RateLimiter, recipient_of
+from worker.lanes import BULK, URGENT, KAFKA_URGENT_TOPIC, LaneScheduler, is_urgent
 import firebase_admin
-from firebase_admin import credentials, messaging
-from typing import Optional
+from firebase_admin import credentials, messaging, exceptions as firebase_exceptions
+from google.auth.credentials import AnonymousCredentials
+from typing import Dict, List, Optional, Tuple
 
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+KAFKA_POLL_TIMEOUT_MS = int(os.getenv("KAFKA_POLL_TIMEOUT_MS", "1000"))
+KAFKA_MAX_POLL_RECORDS = int(os.getenv("KAFKA_MAX_POLL_RECORDS", "500"))
+
+# Firebase errors that mean "try again later" rather than "this message can never be delivered"
+TRANSIENT_FIREBASE_ERRORS = (
+    firebase_exceptions.UnavailableError,
+    firebase_exceptions.InternalError,
+    firebase_exceptions.DeadlineExceededError,
+    firebase_exceptions.ResourceExhaustedError,
+)
+
+# FCM accepts at most 500 tokens per multicast; device tokens are fetched this many at a time
+FCM_MULTICAST_LIMIT = 500
+TOKEN_LOOKUP_CONCURRENCY = int(os.getenv("TOKEN_LOOKUP_CONCURRENCY", "32"))
+
+# Base URL of an FCM v1 compatible endpoint (e.g. bench/fakes.py) used instead of Google's, for load tests
+FCM_ENDPOINT = os.getenv("FCM_ENDPOINT")
+FCM_PROJECT_ID = os.getenv("FCM_PROJECT_ID", "local-test")
+
+DECODE_TIMER = DecodeTimer()
 
 
 
@@ -32,8 +63,22 @@ def get_db() -> Session:
         db.close()
 
 
+class _AnonymousCredential(credentials.Base):
+    """No OAuth token: the local FCM stand-in does not check one"""
+
+    def get_credential(self):
+        return AnonymousCredentials()
+
+
 def initialize_firebase():
     """Initialize Firebase Admin SDK"""
+    if FCM_ENDPOINT:
+        # The SDK has no emulator setting, its v1 send URL is a class attribute
+        messaging._MessagingService.FCM_URL = FCM_ENDPOINT.rstrip("/") + "/v1/projects/{0}/messages:send"
+        firebase_admin.initialize_app(_AnonymousCredential(), {"projectId": FCM_PROJECT_ID})
+        logger.warning(f"Firebase messages go to {FCM_ENDPOINT}, not to FCM")
+        return
+
     cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "./firebase-service-account.json")
     cred = credentials.Certificate(cred_path)
     firebase_admin.initialize_app(cred)
@@ -45,6 +90,39 @@ def get_db_session():
     return SessionLocal()
 
 
+class WorkerContext:
+    """Delivery state kept for the lifetime of a consumer process"""
+
+    def __init__(self, history: HistoryBuffer, retries: RetryScheduler, dedup: Optional[DedupStore] = None,
+                 coalescer: Optional[Coalescer] = None, rate_limiter: Optional[RateLimiter] = None,
+                 lanes: Optional[LaneScheduler] = None):
+        self.history = history
+        self.retries = retries
+        self.dedup = dedup
+        self.coalescer = coalescer
+        self.rate_limiter = rate_limiter
+        self.lanes = lanes
+
+
+def record_history(db: Session, history: Optional[HistoryBuffer], user_id: str, message: str, status: str,
+                   notification_id: Optional[int] = None):
+    """Stage a history record in the batch buffer, or write it directly when there is none.
+
+    Messages submitted through the API carry a ``notification_id``; its
+    notifications row follows the same status.
+    """
+    metrics.OUTCOMES.labels(status).inc()
+
+    if history is not None:
+        history.add(user_id=user_id, message=message, status=status)
+        if notification_id:
+            history.set_status(notification_id, status)
+    else:
+        crud.create_notification_history(db=db, user_id=user_id, message=message, status=status)
+        if notification_id:
+            crud.update_notification_status(db=db, notification_id=notification_id, status=status)
+
+
 def send_firebase_notification(device_token: str, title: str, body: str, data: Optional[dict] = None):
     """Send a notification via Firebase"""
     try:
@@ -59,17 +137,146 @@ def send_firebase_notification(device_token: str, title: str, body: str, data: O
             token=device_token,
         )
 
-        response = messaging.send(message)
+        with metrics.stage("fcm_send"):
+            response = messaging.send(message)
         logger.info(f"Successfully sent Firebase message: {response}")
         return True
+    except TRANSIENT_FIREBASE_ERRORS as e:
+        metrics.FCM_ERRORS.labels(metrics.fcm_error_code(e)).inc()
+        raise RetryableNotificationError(f"Firebase temporarily unavailable: {e}") from e
     except Exception as e:
+        metrics.FCM_ERRORS.labels(metrics.fcm_error_code(e)).inc()
         logger.error(f"Error sending Firebase notification: {e}")
         return False
 
 
-def process_notification_message(message_value: dict, db: Session):
-    """Process a notification message from Kafka"""
+def fcm_data(message_value: dict) -> dict:
+    """FCM data payload, plus the trace context so the app can report it back with the delivery"""
+    data = dict(message_value.get('data') or {})
+    if message_value.get('traceparent'):
+        data[tracing.TRACEPARENT_HEADER] = tracing.child_traceparent(message_value['traceparent'])
+    return data
+
+
+def fetch_device_tokens(client: httpx.Client, auth_service_url: str, user_ids: List[str]) -> Tuple[Dict[str, str], List[str], List[str]]:
+    """Resolve many device tokens concurrently over one pooled client.
+
+    Returns (tokens by user, users without a token, users whose lookup failed
+    transiently and should be retried).
+    """
+    def lookup(user_id):
+        try:
+            response = client.get(f"{auth_service_url}/auth/users/{user_id}/device_token")
+        except httpx.RequestError:
+            return user_id, None, True
+        if response.status_code >= 500 or response.status_code == 429:
+            return user_id, None, True
+        if response.status_code != 200:
+            return user_id, None, False
+        return user_id, response.json().get('device_token'), False
+
+    tokens, missing, transient = {}, [], []
+    with ThreadPoolExecutor(max_workers=TOKEN_LOOKUP_CONCURRENCY) as pool:
+        for user_id, token, retry in pool.map(lookup, user_ids):
+            if retry:
+                transient.append(user_id)
+            elif token:
+                tokens[user_id] = token
+            else:
+                missing.append(user_id)
+    return tokens, missing, transient
+
+
+def send_firebase_multicast(tokens: Dict[str, str], title: str, body: str, data: Optional[dict] = None) -> Tuple[List[str], List[str], List[str]]:
+    """Send one notification to many devices, 500 tokens per FCM call.
+
+    Returns (users sent, users failed permanently, users failed transiently).
+    """
+    sent, failed, transient = [], [], []
+    items = list(tokens.items())
+
+    for start in range(0, len(items), FCM_MULTICAST_LIMIT):
+        chunk = items[start:start + FCM_MULTICAST_LIMIT]
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            data=data or {},
+            tokens=[token for _, token in chunk],
+        )
+
+        try:
+            with metrics.stage("fcm_send"):
+                batch = messaging.send_each_for_multicast(message)
+        except TRANSIENT_FIREBASE_ERRORS as e:
+            metrics.FCM_ERRORS.labels(metrics.fcm_error_code(e)).inc(len(chunk))
+            transient.extend(user_id for user_id, _ in chunk)
+            continue
+        except Exception as e:
+            metrics.FCM_ERRORS.labels(metrics.fcm_error_code(e)).inc(len(chunk))
+            logger.error(f"Error sending Firebase multicast: {e}")
+            failed.extend(user_id for user_id, _ in chunk)
+            continue
+
+        for (user_id, _), response in zip(chunk, batch.responses):
+            if response.success:
+                sent.append(user_id)
+                continue
+
+            metrics.FCM_ERRORS.labels(metrics.fcm_error_code(response.exception)).inc()
+            if isinstance(response.exception, TRANSIENT_FIREBASE_ERRORS):
+                transient.append(user_id)
+            else:
+                failed.append(user_id)
+
+    logger.info(f"Firebase multicast: {len(sent)} sent, {len(failed)} failed, {len(transient)} to retry")
+    return sent, failed, transient
+
+
+def process_broadcast_chunk(message_value: dict, db: Session, history: Optional[HistoryBuffer] = None):
+    """Deliver one broadcast chunk: bulk token lookup, then FCM multicast.
+
+    Recipients whose token lookup or send failed transiently are retried
+    together as a smaller chunk; everyone else gets a history record.
+    """
+    user_ids = [str(u) for u in message_value.get('user_ids', [])]
+    title = message_value.get('title', 'Bus Alert')
+    body = message_value.get('body', 'You have received a notification.')
+    data = fcm_data(message_value)
+    auth_service_url = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8000")
+
+    limits = httpx.Limits(max_connections=TOKEN_LOOKUP_CONCURRENCY, max_keepalive_connections=TOKEN_LOOKUP_CONCURRENCY)
+    with httpx.Client(limits=limits) as client, metrics.stage("token_lookup"):
+        tokens, missing, retry_users = fetch_device_tokens(client, auth_service_url, user_ids)
+
+    sent, failed, transient = send_firebase_multicast(tokens, title, body, data) if tokens else ([], [], [])
+    retry_users += transient
+
+    for user_id in missing:
+        record_history(db=db, history=history, user_id=user_id, message="No device token found", status="failed")
+    for user_id in failed:
+        record_history(db=db, history=history, user_id=user_id, message=f"Notification failed: {title} - {body}", status="failed")
+    for user_id in sent:
+        record_history(db=db, history=history, user_id=user_id, message=f"Notification sent: {title} - {body}", status="sent")
+
+    if retry_users:
+        raise RetryableNotificationError(
+            f"{len(retry_users)} of {len(user_ids)} broadcast recipients failed transiently",
+            payload={**message_value, "user_ids": retry_users}
+        )
+
+    return not failed and not missing
+
+
+def process_notification_message(message_value: dict, db: Session, history: Optional[HistoryBuffer] = None,
+                                 rate_limiter: Optional[RateLimiter] = None):
+    """Process a notification message from Kafka.
+
+    The rate limiter is applied to the resolved recipient (the parent, for a
+    student's message), so a parent's budget covers all of their children.
+    """
     logger.info(f"Processing message: {message_value}")
+
+    if message_value.get('user_ids'):
+        return process_broadcast_chunk(message_value, db, history)
     
     
     notification_type_name = message_value.get('notification_type', 'eta_update')
@@ -102,22 +309,31 @@ def process_notification_message(message_value: dict, db: Session):
             parent_id = user_id
             if message_value.get('student_id'):
                 
-                student_response = client.get(f"{student_service_url}/students/{message_value['student_id']}")
+                with metrics.stage("student_lookup"):
+                    student_response = client.get(f"{student_service_url}/students/{message_value['student_id']}")
                 
                 if student_response.status_code == 200:
                     student_data = student_response.json()
                     parent_id = student_data.get('parent_id', user_id)  
+                elif student_response.status_code >= 500:
+                    raise RetryableNotificationError(f"Student service error: {student_response.status_code}")
                 else:
                     logger.warning(f"Could not get student info: {student_response.status_code}")
             
             
-            token_response = client.get(f"{auth_service_url}/auth/users/{parent_id}/device_token")
+            with metrics.stage("token_lookup"):
+                token_response = client.get(f"{auth_service_url}/auth/users/{parent_id}/device_token")
             
+            if token_response.status_code >= 500 or token_response.status_code == 429:
+                raise RetryableNotificationError(f"Auth service error while fetching device token: {token_response.status_code}")
+
             if token_response.status_code != 200:
                 logger.error(f"Failed to get device token for user {parent_id}: {token_response.status_code}")
                 
-                crud.create_notification_history(
+                record_history(
                     db=db,
+                    history=history,
+                    notification_id=message_value.get('notification_id'),
                     user_id=parent_id,
                     message="Failed to retrieve device token",
                     status="failed"
@@ -129,8 +345,10 @@ def process_notification_message(message_value: dict, db: Session):
             if not device_token:
                 logger.error(f"No device token found for user {parent_id}")
                 
-                crud.create_notification_history(
+                record_history(
                     db=db,
+                    history=history,
+                    notification_id=message_value.get('notification_id'),
                     user_id=parent_id,
                     message="No device token found",
                     status="failed"
@@ -138,18 +356,21 @@ def process_notification_message(message_value: dict, db: Session):
                 return False
             
             
-            subscription = crud.get_user_subscription_by_type(
-                db=db,
-                user_id=parent_id,
-                notification_type_id=notification_type_id
-            )
+            with metrics.stage("subscription_check"):
+                subscription = crud.get_user_subscription_by_type(
+                    db=db,
+                    user_id=parent_id,
+                    notification_type_id=notification_type_id
+                )
             
             
             if subscription and not subscription.is_subscribed:
                 logger.info(f"User {parent_id} unsubscribed from notification type {notification_type_name}, skipping")
                 
-                crud.create_notification_history(
+                record_history(
                     db=db,
+                    history=history,
+                    notification_id=message_value.get('notification_id'),
                     user_id=parent_id,
                     message=f"Notification not sent: user unsubscribed from {notification_type_name}",
                     status="skipped"
@@ -157,9 +378,20 @@ def process_notification_message(message_value: dict, db: Session):
                 return True  
             
             
+            if rate_limiter is not None and not rate_limiter.allow(str(parent_id)):
+                record_history(
+                    db=db,
+                    history=history,
+                    notification_id=message_value.get('notification_id'),
+                    user_id=parent_id,
+                    message=f"Notification suppressed: more than {rate_limiter.per_minute} pushes in a minute",
+                    status="rate_limited"
+                )
+                return True
+            
             title = message_value.get('title', 'Bus Alert')
             body = message_value.get('body', 'You have received a notification.')
-            data = message_value.get('data', {})
+            data = fcm_data(message_value)
             
             
             if notification_type_name == 'eta_update':
@@ -172,21 +404,29 @@ def process_notification_message(message_value: dict, db: Session):
             
             
             status = "sent" if success else "failed"
-            crud.create_notification_history(
+            record_history(
                 db=db,
+                history=history,
+                notification_id=message_value.get('notification_id'),
                 user_id=parent_id,
                 message=f"Notification {status}: {title} - {body}",
                 status=status
             )
             
             return success
-            
+
+    except RetryableNotificationError:
+        raise
+    except httpx.RequestError as e:
+        raise RetryableNotificationError(f"Could not reach upstream service: {e}") from e
     except Exception as e:
         logger.error(f"Error processing notification message: {e}")
         
         
-        crud.create_notification_history(
+        record_history(
             db=db,
+            history=history,
+            notification_id=message_value.get('notification_id'),
             user_id=user_id,
             message=f"Error processing notification: {str(e)}",
             status="failed"
@@ -198,80 +438,311 @@ def main():
     """Main function to start the Kafka consumer"""
     logger.info("Starting Kafka consumer...")
 
-    
-    try:
-        models.Base.metadata.create_all(bind=engine)
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize database: {e}")
-        return
-
-    
+    # Tables and partitions are created by the migration step (python -m app.migrate)
     try:
         initialize_firebase()
     except Exception as e:
         logger.error(f"Failed to initialize Firebase: {e}")
         return
 
+    # Creates next months' partitions and archives expired ones; one replica at a time
+    partitions.start_maintenance_thread(engine)
+    metrics.start_metrics_server(metrics.WORKER_METRICS_PORT)
+
     
     kafka_bootstrap_servers = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092").split(',')
     topic = os.getenv("KAFKA_NOTIFICATIONS_TOPIC", "eta_notifications")
     
     topics = [topic] + os.getenv("KAFKA_ADDITIONAL_TOPICS", "").split(",") if os.getenv("KAFKA_ADDITIONAL_TOPICS") else [topic]
     topics = [t.strip() for t in topics if t.strip()]  
+    if KAFKA_URGENT_TOPIC not in topics:
+        topics.append(KAFKA_URGENT_TOPIC)
 
     
     consumer = KafkaConsumer(
         *topics,
         bootstrap_servers=kafka_bootstrap_servers,
-        value_deserializer=lambda m: json.loads(m.decode('utf-8')),
         auto_offset_reset='earliest',
-        enable_auto_commit=True,
+        enable_auto_commit=False,
+        max_poll_records=KAFKA_MAX_POLL_RECORDS,
         group_id='notification-group'
     )
 
     logger.info(f"Connected to Kafka, listening on topics: {topics}")
 
-    
-    for message in consumer:
-        try:
-            logger.info(f"Received message: {message.value}")
+    ctx = WorkerContext(
+        history=HistoryBuffer(),
+        retries=RetryScheduler(create_producer(kafka_bootstrap_servers), base_topic=topic),
+        dedup=DedupStore(),
+        coalescer=Coalescer(),
+        rate_limiter=RateLimiter(),
+        lanes=LaneScheduler()
+    )
 
-            
-            db = get_db_session()
+    while True:
+        apply_backpressure(consumer, ctx.lanes)
 
-            try:
-                
-                success = process_notification_message(message.value, db)
-                
-                if success:
-                    logger.info("Message processed successfully")
-                else:
-                    logger.error("Failed to process message")
-                    
-            except Exception as e:
-                logger.error(f"Error in processing loop: {e}")
+        # Don't wait for new records while there is queued work; poll(0) just picks up urgent arrivals
+        batches = consumer.poll(timeout_ms=0 if ctx.lanes else KAFKA_POLL_TIMEOUT_MS)
+        enqueue_batches(batches, ctx)
 
-                
-                user_id = message.value.get('user_id', message.value.get('student_id', 'unknown'))
+        if not ctx.lanes and not ctx.coalescer:
+            continue
 
-                
-                crud.create_notification_history(
-                    db=db,
-                    user_id=user_id,
-                    message=f"Error processing notification: {str(e)}",
-                    status="failed"
-                )
+        process_round(consumer, ctx.lanes.next_round(), ctx)
 
-            finally:
-                
-                db.close()
+        ctx.lanes.update_lag(consumer)
+        ctx.lanes.maybe_report(extra={"Decode": DECODE_TIMER})
 
-        except json.JSONDecodeError:
-            logger.error("Failed to decode JSON message")
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
 
+def decode_message(message, retries: Optional[RetryScheduler] = None) -> Optional[dict]:
+    """Decode and validate a Kafka record against the event schema.
+
+    Records that are malformed or fail validation are rejected here, before any
+    network work, and sent to the dead-letter topic when a scheduler is given.
+    """
+    started = time.perf_counter_ns()
+    try:
+        value = decode_value(message.value, message.headers, envelope=is_retry_topic(message.topic))
+    except msgspec.DecodeError as e:
+        DECODE_TIMER.errors += 1
+        metrics.OUTCOMES.labels("invalid").inc()
+        logger.error(f"Rejected invalid message at {message.topic}[{message.partition}]@{message.offset}: {e}")
+        if retries is not None:
+            retries.dead_letter_raw(message.value, str(e), origin_topic=message.topic)
+        return None
+
+    DECODE_TIMER.observe(started)
+    metrics.observe_stage("decode", (time.perf_counter_ns() - started) / 1e9)
+
+    # The producer's trace context travels with the payload through coalescing and retries
+    traceparent = tracing.from_kafka_headers(message.headers)
+    if traceparent:
+        payload, _ = unwrap_envelope(value)
+        payload.setdefault("traceparent", traceparent)
+    return value
+
+
+def deliver(message_value: dict, db: Session, ctx: WorkerContext, attempt: int = 0,
+            idempotency_key: Optional[str] = None, urgent: bool = False):
+    """Process one notification payload, handing transient failures to the retry tiers.
+
+    With a dedup store, the idempotency key is claimed first (usually ahead, with
+    the rest of the round) and a duplicate is dropped without any network work;
+    the claim is released if the delivery goes to a retry tier or the dead-letter
+    topic, so the retry or a replay of the dead letter is not mistaken for a
+    duplicate. Pushes beyond the resolved recipient's per-minute budget are recorded as
+    rate_limited, except for urgent messages (``urgent`` is set for records read
+    from the urgent topic, whatever their payload says).
+    """
+    history, retries, dedup = ctx.history, ctx.retries, ctx.dedup
+
+    if dedup is not None and idempotency_key:
+        if not dedup.claim(db, idempotency_key):
+            logger.info(f"Duplicate notification {idempotency_key}, skipping")
+            return
+
+    rate_limiter = None if urgent or is_urgent(message_value) else ctx.rate_limiter
+
+    try:
+        success = process_notification_message(message_value, db, history, rate_limiter)
+
+        if success:
+            logger.info("Message processed successfully")
+        else:
+            logger.error("Failed to process message")
+
+    except RetryableNotificationError as e:
+        user_id = message_value.get('user_id', message_value.get('student_id', message_value.get('broadcast_id', 'unknown')))
+        topic = retries.schedule(e.payload or message_value, str(e), attempt, idempotency_key=idempotency_key)
+        dead = retries.is_dead_letter(topic)
+
+        if dedup is not None and idempotency_key:
+            dedup.release(db, idempotency_key)
+
+        record_history(
+            db=db,
+            history=history,
+            notification_id=message_value.get('notification_id'),
+            user_id=user_id,
+            message=f"Notification {'dead-lettered' if dead else 'scheduled for retry'}: {str(e)}",
+            status="failed" if dead else "retrying"
+        )
+
+    except Exception as e:
+        logger.error(f"Error in processing loop: {e}")
+
+        user_id = message_value.get('user_id', message_value.get('student_id', 'unknown'))
+
+        record_history(
+            db=db,
+            history=history,
+            notification_id=message_value.get('notification_id'),
+            user_id=user_id,
+            message=f"Error processing notification: {str(e)}",
+            status="failed"
+        )
+
+
+def message_key(message, message_value: dict) -> str:
+    """Idempotency key of a record; retry envelopes carry the key of the original message"""
+    payload, attempt = unwrap_envelope(message_value)
+    return (message_value.get("idempotency_key") if attempt else None) or idempotency_key_for(message, payload)
+
+
+def held_by_coalescer(payload: dict, attempt: int, ctx: WorkerContext, urgent: bool) -> bool:
+    # Urgent messages, on the urgent lane by topic or payload, are never held
+    return attempt == 0 and not urgent and ctx.coalescer is not None and ctx.coalescer.accepts(payload)
+
+
+def claim_round(selected: list, db: Session, ctx: WorkerContext):
+    """Claim the idempotency keys of every record the round delivers now, in one INSERT"""
+    if ctx.dedup is None:
+        return
+
+    keys = []
+    for _, item in selected:
+        payload, attempt = unwrap_envelope(item.value)
+        if not held_by_coalescer(payload, attempt, ctx, is_urgent(payload, item.message.topic)):
+            keys.append(message_key(item.message, item.value))
+    ctx.dedup.claim_many(db, keys)
+
+
+def handle_message(message, db: Session, ctx: WorkerContext, tp=None, message_value: Optional[dict] = None) -> bool:
+    """Decode and process a single Kafka record, staging its history in the buffer.
+
+    First attempts of coalescable types are held in the coalescer instead of
+    being delivered; a message replaced by a newer one is recorded as coalesced.
+    Returns True if the record was handled now rather than held or dropped.
+    """
+    if message_value is None:
+        message_value = decode_message(message, ctx.retries)
+    if message_value is None:
+        return False
+
+    logger.info(f"Received message: {message_value}")
+
+    payload, attempt = unwrap_envelope(message_value)
+    key = message_key(message, message_value)
+    urgent = is_urgent(payload, message.topic)
+
+    if held_by_coalescer(payload, attempt, ctx, urgent):
+        superseded = ctx.coalescer.offer(payload, key, tp=tp, offset=message.offset)
+        if superseded is not None:
+            record_history(
+                db=db,
+                history=ctx.history,
+                notification_id=superseded.payload.get('notification_id'),
+                user_id=recipient_of(superseded.payload),
+                message=f"Notification coalesced: superseded by a newer {payload.get('notification_type', 'eta_update')}",
+                status="coalesced"
+            )
+        return False
+
+    deliver(payload, db, ctx, attempt, idempotency_key=key, urgent=urgent)
+    return True
+
+
+def deliver_due(db: Session, ctx: WorkerContext):
+    """Deliver the newest message of every coalescing window that has elapsed"""
+    if ctx.coalescer is None:
+        return
+
+    due = ctx.coalescer.pop_due()
+    if ctx.dedup is not None:
+        ctx.dedup.claim_many(db, [entry.idempotency_key for entry in due])
+
+    for entry in due:
+        deliver(entry.payload, db, ctx, idempotency_key=entry.idempotency_key)
+
+
+def committable_offsets(consumer: KafkaConsumer, ctx: WorkerContext) -> dict:
+    """Current positions, held back to the oldest message still queued in a lane or the coalescer"""
+    held = [h.held_offsets() for h in (ctx.coalescer, ctx.lanes) if h is not None]
+
+    offsets = {}
+    for tp in consumer.assignment():
+        position = consumer.position(tp)
+        for floors in held:
+            if tp in floors:
+                position = min(position, floors[tp])
+        offsets[tp] = OffsetAndMetadata(position, '', -1)
+    return offsets
+
+
+def enqueue_batches(batches: dict, ctx: WorkerContext):
+    """Decode polled records and queue them on the urgent or bulk lane"""
+    for tp, messages in batches.items():
+        for message in messages:
+            message_value = decode_message(message, ctx.retries)
+            if message_value is None:
+                continue
+
+            payload, _ = unwrap_envelope(message_value)
+            lane = URGENT if is_urgent(payload, tp.topic) else BULK
+            metrics.MESSAGES_CONSUMED.labels(tp.topic, lane).inc()
+            ctx.lanes.enqueue(lane, tp, message, message_value)
+
+
+def apply_backpressure(consumer: KafkaConsumer, lanes: LaneScheduler):
+    """Stop fetching bulk partitions while the bulk lane is full; urgent partitions are never paused"""
+    bulk_partitions = [tp for tp in consumer.assignment() if tp.topic != KAFKA_URGENT_TOPIC]
+    if not bulk_partitions:
+        return
+
+    if lanes.bulk_saturated():
+        consumer.pause(*bulk_partitions)
+    else:
+        consumer.resume(*bulk_partitions)
+
+
+def process_round(consumer: KafkaConsumer, selected: list, ctx: WorkerContext):
+    """Process one scheduling round, flush its history in one insert, then commit offsets.
+
+    The round's dedup claims commit in the same transaction as its history.
+    Retry envelopes are flushed to Kafka before the commit as well. If anything
+    fails the offsets are not committed, the lanes are emptied and the consumer
+    is rewound to the oldest unprocessed record, so no history record or retry
+    is lost. Offsets of messages still queued or held are never committed.
+    """
+    history, retries, lanes = ctx.history, ctx.retries, ctx.lanes
+    db = get_db_session()
+
+    try:
+        claim_round(selected, db, ctx)
+        for lane, item in selected:
+            if handle_message(item.message, db, ctx, item.tp, item.value):
+                lanes.observe_delivery(lane, item.message)
+
+        deliver_due(db, ctx)
+
+        with metrics.stage("history_write"):
+            history.flush(db)
+        # Claims of a round that wrote no history
+        db.commit()
+        if ctx.dedup is not None:
+            ctx.dedup.commit(db)
+        retries.flush()
+        consumer.commit(offsets=committable_offsets(consumer, ctx))
+
+    except Exception as e:
+        logger.error(f"Failed to persist batch, it will be redelivered: {e}")
+        db.rollback()
+        history.clear()
+        if ctx.dedup is not None:
+            ctx.dedup.rollback()
+
+        floors = lanes.held_offsets()
+        for _, item in selected:
+            if item.tp not in floors or item.message.offset < floors[item.tp]:
+                floors[item.tp] = item.message.offset
+        lanes.clear()
+
+        for tp, offset in floors.items():
+            consumer.seek(tp, offset)
+
+    finally:
+        db.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
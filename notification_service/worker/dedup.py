@@ -0,0 +1,139 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+from sqlalchemy.orm import Session
+
+from app import crud
+from worker import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEDUP_TTL_SECONDS = int(os.getenv("NOTIFICATION_DEDUP_TTL_SECONDS", "86400"))
+DEDUP_MAX_ENTRIES = int(os.getenv("NOTIFICATION_DEDUP_MAX_ENTRIES", "100000"))
+DEDUP_PURGE_INTERVAL_SECONDS = 3600
+
+
+def idempotency_key_for(message, payload: dict) -> str:
+    """Key identifying one logical notification.
+
+    Producers can set ``idempotency_key`` explicitly; otherwise the Kafka record
+    coordinates are used, which are identical when a record is redelivered after
+    a rebalance. Retry envelopes carry the key of the record they came from.
+    """
+    key = payload.get("idempotency_key") if isinstance(payload, dict) else None
+    if key:
+        return str(key)
+
+    coordinates = f"{message.topic}:{message.partition}:{message.offset}"
+    return hashlib.sha256(coordinates.encode("utf-8")).hexdigest()
+
+
+class DedupStore:
+    """Time-bounded in-memory set of delivered keys, backed by a Postgres unique index.
+
+    The memory tier answers repeats seen by this process in O(1) without a round
+    trip and is capped at ``max_entries`` (oldest evicted first). The table is the
+    source of truth shared by every replica: a round's keys are claimed with one
+    INSERT ... ON CONFLICT DO NOTHING, so exactly one worker wins a race.
+
+    Claims are not committed by the store: they commit with the round's history
+    (HistoryBuffer.flush), so a round that is rewound or lost in a crash leaves
+    its keys unclaimed and the redelivered messages are processed again. Until
+    then the claimed rows stay locked and a replica claiming the same key waits
+    for the outcome.
+    """
+
+    def __init__(self, ttl_seconds: int = DEDUP_TTL_SECONDS, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # key -> expiry (monotonic seconds), oldest first
+        self._round = {}  # key -> whether it may still be delivered, for claims not committed yet
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+
+    def _evict(self, now: float):
+        while self._seen:
+            key, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def seen(self, key: str) -> bool:
+        """Cheap local check, no database access"""
+        with self._lock:
+            expires_at = self._seen.get(key)
+            return expires_at is not None and expires_at > time.monotonic()
+
+    def claim_many(self, db: Session, keys: Iterable[str]):
+        """Claim the keys about to be delivered with a single INSERT, left uncommitted"""
+        fresh = []
+        for key in dict.fromkeys(keys):
+            if key in self._round:
+                continue
+            if self.seen(key):
+                metrics.CACHE_REQUESTS.labels("dedup", "hit").inc()
+                self._round[key] = False
+            else:
+                metrics.CACHE_REQUESTS.labels("dedup", "miss").inc()
+                fresh.append(key)
+
+        if fresh:
+            claimed = crud.claim_delivery_keys(db=db, idempotency_keys=fresh)
+            for key in fresh:
+                self._round[key] = key in claimed
+
+    def claim(self, db: Session, key: str) -> bool:
+        """Return True if the caller should deliver this key, False if it is a duplicate.
+
+        Keys not claimed ahead with claim_many are claimed on their own.
+        """
+        if key not in self._round:
+            self.claim_many(db, [key])
+        claimed = self._round[key]
+        # A second copy within the same round is a duplicate of the first
+        self._round[key] = False
+        return claimed
+
+    def release(self, db: Session, key: str):
+        """Give a claim back, e.g. when the message goes to a retry tier or the dead-letter topic"""
+        self._round.pop(key, None)
+        with self._lock:
+            self._seen.pop(key, None)
+
+        crud.release_delivery_key(db=db, idempotency_key=key)
+
+    def commit(self, db: Session):
+        """Remember the round's claims locally once its transaction has committed"""
+        with self._lock:
+            now = time.monotonic()
+            for key in self._round:
+                if key in self._seen:
+                    continue
+                self._seen[key] = now + self.ttl_seconds
+                self._seen.move_to_end(key)
+            self._evict(now)
+        self._round = {}
+
+        self._maybe_purge(db)
+
+    def rollback(self):
+        """Forget the round's claims; the database rolled them back"""
+        self._round = {}
+
+    def _maybe_purge(self, db: Session):
+        """Drop expired keys from the table at most once per purge interval"""
+        now = time.monotonic()
+        if now - self._last_purge < DEDUP_PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl_seconds)
+        deleted = crud.purge_delivery_keys(db=db, older_than=cutoff)
+        logger.info(f"Purged {deleted} expired delivery keys")
@@ -0,0 +1,57 @@
+import logging
+from typing import Dict, List
+
+from sqlalchemy.orm import Session
+
+from app import crud
+
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryBuffer:
+    """Stages notification history records in memory and writes them in one bulk insert.
+
+    The consumer flushes the buffer right before committing Kafka offsets, so a
+    batch's history is persisted exactly when its messages are acknowledged.
+    """
+
+    def __init__(self):
+        self._records: List[dict] = []
+        self._statuses: Dict[int, str] = {}
+
+    def __len__(self):
+        return len(self._records) + len(self._statuses)
+
+    def add(self, user_id: str, message: str, status: str):
+        """Stage a history record until the next flush"""
+        self._records.append({
+            "user_id": str(user_id),
+            "message": message,
+            "status": status
+        })
+
+    def set_status(self, notification_id: int, status: str):
+        """Stage the latest delivery status of an API-submitted notification"""
+        self._statuses[int(notification_id)] = status
+
+    def clear(self):
+        """Drop staged records (used when the batch is going to be redelivered)"""
+        self._records = []
+        self._statuses = {}
+
+    def flush(self, db: Session) -> int:
+        """Write all staged records with a single INSERT; records are kept if it fails"""
+        if not self._records and not self._statuses:
+            return 0
+
+        try:
+            written = crud.bulk_create_notification_history(db=db, records=self._records, status_updates=self._statuses)
+        except Exception:
+            db.rollback()
+            raise
+
+        self._records = []
+        self._statuses = {}
+        logger.debug(f"Flushed {written} notification history records")
+        return written
@@ -0,0 +1,176 @@
+import os
+import time
+import math
+import random
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+from worker import metrics
+
+logger = logging.getLogger(__name__)
+
+URGENT = "urgent"
+BULK = "bulk"
+LANES = (URGENT, BULK)
+
+KAFKA_URGENT_TOPIC = os.getenv("KAFKA_URGENT_TOPIC", "urgent_notifications")
+# Notification types that always take the urgent lane, whatever topic they arrive on
+URGENT_TYPES = {t.strip() for t in os.getenv("NOTIFICATION_URGENT_TYPES", "bus_incident,student_not_boarded").split(",") if t.strip()}
+# Messages handled per scheduling round, and how many urgent slots there are per bulk slot
+LANE_ROUND_SIZE = int(os.getenv("NOTIFICATION_LANE_ROUND_SIZE", "50"))
+LANE_URGENT_WEIGHT = int(os.getenv("NOTIFICATION_LANE_URGENT_WEIGHT", "4"))
+# Stop fetching bulk partitions while this many bulk messages are already queued
+LANE_MAX_QUEUED = int(os.getenv("NOTIFICATION_LANE_MAX_QUEUED", "1000"))
+LANE_STATS_INTERVAL_SECONDS = 60
+
+
+def is_urgent(payload: dict, topic: Optional[str] = None) -> bool:
+    """Safety alerts: the urgent topic, an explicit priority, or an urgent notification type"""
+    if topic == KAFKA_URGENT_TOPIC:
+        return True
+    if not isinstance(payload, dict):
+        return False
+    return payload.get("priority") == URGENT or payload.get("notification_type") in URGENT_TYPES
+
+
+class QueuedMessage:
+    __slots__ = ("tp", "message", "value", "enqueued_at")
+
+    def __init__(self, tp, message, value):
+        self.tp = tp
+        self.message = message
+        self.value = value
+        self.enqueued_at = time.monotonic()
+
+
+class LatencyStats:
+    """Count/mean/max plus a small reservoir sample for percentiles"""
+
+    def __init__(self, reservoir_size: int = 1024):
+        self.reservoir_size = reservoir_size
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._sample: List[float] = []
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self._sample) < self.reservoir_size:
+            self._sample.append(seconds)
+        else:
+            slot = random.randrange(self.count)
+            if slot < self.reservoir_size:
+                self._sample[slot] = seconds
+
+    def percentile(self, p: float) -> float:
+        if not self._sample:
+            return 0.0
+        ordered = sorted(self._sample)
+        return ordered[min(len(ordered) - 1, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+    def summary(self) -> str:
+        if not self.count:
+            return "no messages"
+        return (f"n={self.count} mean={self.total / self.count * 1000:.0f}ms "
+                f"p50={self.percentile(50) * 1000:.0f}ms p95={self.percentile(95) * 1000:.0f}ms "
+                f"p99={self.percentile(99) * 1000:.0f}ms max={self.max * 1000:.0f}ms")
+
+
+class LaneScheduler:
+    """Weighted two-lane scheduler in front of delivery.
+
+    Each round takes urgent messages first, but reserves one slot in every
+    ``urgent_weight + 1`` for the bulk lane whenever it has work, so a flood of
+    urgent alerts cannot starve routine traffic and a bulk backlog never sits in
+    front of an urgent push for more than one (small) round.
+    """
+
+    def __init__(self, round_size: int = LANE_ROUND_SIZE, urgent_weight: int = LANE_URGENT_WEIGHT,
+                 max_queued: int = LANE_MAX_QUEUED):
+        self.round_size = round_size
+        self.urgent_weight = urgent_weight
+        self.max_queued = max_queued
+        self._queues: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self.latency = {lane: LatencyStats() for lane in LANES}
+        self.lag: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._last_report = time.monotonic()
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def queued(self, lane: str) -> int:
+        return len(self._queues[lane])
+
+    def enqueue(self, lane: str, tp, message, value):
+        self._queues[lane].append(QueuedMessage(tp, message, value))
+
+    def bulk_saturated(self) -> bool:
+        return len(self._queues[BULK]) >= self.max_queued
+
+    def next_round(self) -> List[tuple]:
+        """Up to ``round_size`` (lane, QueuedMessage) pairs, urgent first"""
+        urgent, bulk = self._queues[URGENT], self._queues[BULK]
+        bulk_slots = min(len(bulk), max(1, self.round_size // (self.urgent_weight + 1))) if bulk else 0
+        urgent_slots = min(len(urgent), self.round_size - bulk_slots)
+        bulk_slots = min(len(bulk), self.round_size - urgent_slots)
+
+        selected = [(URGENT, urgent.popleft()) for _ in range(urgent_slots)]
+        selected += [(BULK, bulk.popleft()) for _ in range(bulk_slots)]
+        return selected
+
+    def held_offsets(self) -> Dict:
+        """Lowest queued offset per partition; queued messages must not be committed yet"""
+        floors = {}
+        for queue in self._queues.values():
+            for item in queue:
+                if item.tp not in floors or item.message.offset < floors[item.tp]:
+                    floors[item.tp] = item.message.offset
+        return floors
+
+    def clear(self):
+        for queue in self._queues.values():
+            queue.clear()
+
+    def observe_delivery(self, lane: str, message):
+        """End-to-end latency from the producer's record timestamp to delivery"""
+        if message.timestamp and message.timestamp > 0:
+            seconds = max(0.0, time.time() - message.timestamp / 1000.0)
+            self.latency[lane].observe(seconds)
+            metrics.END_TO_END_SECONDS.labels(lane).observe(seconds)
+
+    def update_lag(self, consumer):
+        """Per-lane consumer lag: records still on the broker plus records queued here"""
+        lag = {lane: self.queued(lane) for lane in LANES}
+        for tp in consumer.assignment():
+            highwater = consumer.highwater(tp)
+            if highwater is None:
+                continue
+            lane = URGENT if tp.topic == KAFKA_URGENT_TOPIC else BULK
+            partition_lag = max(0, highwater - consumer.position(tp))
+            lag[lane] += partition_lag
+            metrics.CONSUMER_LAG.labels(tp.topic, tp.partition).set(partition_lag)
+        self.lag = lag
+
+        for lane in LANES:
+            metrics.LANE_QUEUED.labels(lane).set(self.queued(lane))
+
+    def maybe_report(self, extra: Optional[Dict] = None):
+        """Log per-lane stats (and any ``extra`` named stats with summary()/reset()) once per interval"""
+        now = time.monotonic()
+        if now - self._last_report < LANE_STATS_INTERVAL_SECONDS:
+            return
+        self._last_report = now
+
+        for lane in LANES:
+            logger.info(f"Lane {lane}: lag={self.lag[lane]} latency {self.latency[lane].summary()}")
+            self.latency[lane].reset()
+
+        for name, stats in (extra or {}).items():
+            logger.info(f"{name}: {stats.summary()}")
+            stats.reset()
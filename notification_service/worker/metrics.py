@@ -0,0 +1,68 @@
+import os
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+logger = logging.getLogger(__name__)
+
+# Port of the Prometheus endpoint (GET /metrics); the retry consumer uses its own
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+RETRY_WORKER_METRICS_PORT = int(os.getenv("RETRY_WORKER_METRICS_PORT", "9101"))
+
+# Stages timed for every notification, from the Kafka record to the history write
+STAGES = ("decode", "student_lookup", "token_lookup", "subscription_check", "fcm_send", "history_write")
+
+MESSAGES_CONSUMED = Counter(
+    "notification_messages_consumed_total", "Kafka records consumed", ["topic", "lane"]
+)
+OUTCOMES = Counter(
+    "notification_outcomes_total", "Notifications by final history status", ["status"]
+)
+STAGE_SECONDS = Histogram(
+    "notification_stage_seconds", "Time spent per pipeline stage", ["stage"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+END_TO_END_SECONDS = Histogram(
+    "notification_end_to_end_seconds", "Producer record timestamp to delivery", ["lane"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+)
+CONSUMER_LAG = Gauge(
+    "notification_consumer_lag", "Records on the broker not yet consumed", ["topic", "partition"]
+)
+LANE_QUEUED = Gauge(
+    "notification_lane_queued", "Records decoded and waiting in a lane", ["lane"]
+)
+FCM_ERRORS = Counter(
+    "notification_fcm_errors_total", "Firebase send failures by error code", ["code"]
+)
+CACHE_REQUESTS = Counter(
+    "notification_cache_requests_total", "In-process cache lookups", ["cache", "result"]
+)
+
+# Labelled children are resolved once; the hot path only pays for the observation
+_stage_timers = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+
+
+def stage(name: str):
+    """Context manager timing one pipeline stage: ``with metrics.stage("fcm_send"): ...``"""
+    return _stage_timers[name].time()
+
+
+def observe_stage(name: str, seconds: float):
+    _stage_timers[name].observe(seconds)
+
+
+def fcm_error_code(error: Exception) -> str:
+    """FCM/Firebase error code (e.g. UNREGISTERED, UNAVAILABLE), or the exception class"""
+    code = getattr(error, "code", None)
+    return str(code) if code else type(error).__name__
+
+
+def start_metrics_server(port: int = WORKER_METRICS_PORT):
+    """Serve /metrics from a background thread; metrics are optional, so failures only log"""
+    try:
+        start_http_server(port)
+        logger.info(f"Serving Prometheus metrics on :{port}/metrics")
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on port {port}: {e}")
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import base64
+import logging
+from typing import List, Optional, Tuple
+
+from kafka import KafkaProducer
+
+
+logger = logging.getLogger(__name__)
+
+# Delays (seconds) of the retry tiers, e.g. "10,60,600" -> eta_notifications.retry.10s, .retry.60s, .retry.600s
+RETRY_DELAYS = [int(d) for d in os.getenv("NOTIFICATION_RETRY_DELAYS", "10,60,600").split(",") if d.strip()]
+
+
+class RetryableNotificationError(Exception):
+    """A transient failure (service outage, FCM unavailable...) worth retrying later.
+
+    ``payload`` narrows what is retried, e.g. only the recipients of a broadcast
+    chunk that failed; by default the whole message is retried.
+    """
+
+    def __init__(self, message: str, payload: Optional[dict] = None):
+        super().__init__(message)
+        self.payload = payload
+
+
+def retry_topic(base_topic: str, delay: int) -> str:
+    return f"{base_topic}.retry.{delay}s"
+
+
+def dead_letter_topic(base_topic: str) -> str:
+    return f"{base_topic}.dlq"
+
+
+def retry_topics(base_topic: str) -> List[str]:
+    return [retry_topic(base_topic, delay) for delay in RETRY_DELAYS]
+
+
+def is_retry_topic(topic: str) -> bool:
+    return ".retry." in topic
+
+
+def create_producer(bootstrap_servers: List[str]) -> KafkaProducer:
+    """Producer used to publish retry and dead-letter envelopes"""
+    return KafkaProducer(
+        bootstrap_servers=bootstrap_servers,
+        value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+        acks='all',
+        linger_ms=5
+    )
+
+
+def unwrap_envelope(value: dict) -> Tuple[dict, int]:
+    """Return (original payload, attempts already made) for a main-topic message or a retry envelope"""
+    if isinstance(value, dict) and "payload" in value and "attempt" in value:
+        return value["payload"], int(value["attempt"])
+    return value, 0
+
+
+class RetryScheduler:
+    """Routes failed notifications to the next retry tier, or to the dead-letter topic.
+
+    Nothing sleeps here: the envelope carries a ``not_before`` timestamp and the
+    retry consumer (worker/retry_consumer.py) waits for it by pausing partitions.
+    """
+
+    def __init__(self, producer: KafkaProducer, base_topic: str):
+        self.producer = producer
+        self.base_topic = base_topic
+
+    def schedule(self, payload: dict, error: str, attempt: int, origin_topic: Optional[str] = None,
+                 idempotency_key: Optional[str] = None) -> str:
+        """Publish the payload to the tier matching ``attempt``; returns the topic used"""
+        envelope = {
+            "payload": payload,
+            "error": error,
+            "attempt": attempt + 1,
+            "origin_topic": origin_topic or self.base_topic,
+            "failed_at": time.time(),
+            "idempotency_key": idempotency_key
+        }
+
+        if attempt < len(RETRY_DELAYS):
+            delay = RETRY_DELAYS[attempt]
+            envelope["not_before"] = envelope["failed_at"] + delay
+            topic = retry_topic(self.base_topic, delay)
+            logger.warning(f"Scheduling retry {attempt + 1}/{len(RETRY_DELAYS)} in {delay}s: {error}")
+        else:
+            topic = dead_letter_topic(self.base_topic)
+            logger.error(f"Retries exhausted, sending to dead-letter topic {topic}: {error}")
+
+        self.producer.send(topic, envelope)
+        return topic
+
+    def dead_letter_raw(self, raw_value: bytes, error: str, origin_topic: Optional[str] = None):
+        """Send an undecodable record straight to the dead-letter topic, keeping its original bytes"""
+        if not isinstance(raw_value, (bytes, bytearray, memoryview)):
+            raw_value = b""  # tombstone
+        self.producer.send(dead_letter_topic(self.base_topic), {
+            "payload": None,
+            "raw_payload": base64.b64encode(raw_value).decode("ascii"),
+            "error": error,
+            "attempt": 0,
+            "origin_topic": origin_topic or self.base_topic,
+            "failed_at": time.time()
+        })
+
+    def is_dead_letter(self, topic: str) -> bool:
+        return topic == dead_letter_topic(self.base_topic)
+
+    def flush(self):
+        """Block until every scheduled envelope is acknowledged (called before committing offsets)"""
+        self.producer.flush()
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import logging
+from kafka import KafkaConsumer
+
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from worker.consumer import (
+    KAFKA_MAX_POLL_RECORDS,
+    KAFKA_POLL_TIMEOUT_MS,
+    WorkerContext,
+    decode_message,
+    deliver,
+    get_db_session,
+    initialize_firebase,
+)
+from worker.history_buffer import HistoryBuffer
+from worker import metrics
+from worker.dedup import DedupStore, idempotency_key_for
+from worker.lanes import is_urgent
+from worker.retry import RetryScheduler, create_producer, retry_topics, unwrap_envelope
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def resume_due_partitions(consumer: KafkaConsumer, paused: dict):
+    """Resume every parked partition whose head message is now due"""
+    now = time.time()
+    assigned = consumer.assignment()
+
+    for tp, not_before in list(paused.items()):
+        if tp not in assigned:
+            # Lost in a rebalance; the new owner will see the record again
+            del paused[tp]
+        elif not_before <= now:
+            consumer.resume(tp)
+            del paused[tp]
+
+
+def next_poll_timeout_ms(paused: dict) -> int:
+    """Poll no longer than it takes for the earliest parked partition to become due"""
+    if not paused:
+        return KAFKA_POLL_TIMEOUT_MS
+
+    wait_ms = int((min(paused.values()) - time.time()) * 1000)
+    return max(0, min(KAFKA_POLL_TIMEOUT_MS, wait_ms))
+
+
+def process_retry_batch(consumer: KafkaConsumer, batches: dict, ctx: WorkerContext, paused: dict):
+    """Deliver due retry envelopes; park a partition at the first envelope that is not due yet.
+
+    Envelopes in one tier topic are ordered by ``not_before`` (they all share the
+    same delay), so pausing at the first early one never delays a due message.
+    The due envelopes' idempotency keys are claimed together and commit with
+    the batch's history.
+    """
+    now = time.time()
+    db = get_db_session()
+
+    try:
+        due = []
+        for tp, messages in batches.items():
+            for message in messages:
+                envelope = decode_message(message, ctx.retries)
+                if envelope is None:
+                    continue
+
+                not_before = envelope.get("not_before", 0)
+                if not_before > now:
+                    consumer.seek(tp, message.offset)
+                    consumer.pause(tp)
+                    paused[tp] = not_before
+                    break
+
+                metrics.MESSAGES_CONSUMED.labels(tp.topic, "retry").inc()
+                payload, attempt = unwrap_envelope(envelope)
+                key = envelope.get("idempotency_key") or idempotency_key_for(message, payload)
+                due.append((payload, attempt, key, is_urgent(payload, envelope.get("origin_topic"))))
+
+        ctx.dedup.claim_many(db, [key for _, _, key, _ in due])
+        for payload, attempt, key, urgent in due:
+            deliver(payload, db, ctx, attempt, idempotency_key=key, urgent=urgent)
+
+        with metrics.stage("history_write"):
+            ctx.history.flush(db)
+        db.commit()
+        ctx.dedup.commit(db)
+        ctx.retries.flush()
+        consumer.commit()
+
+    except Exception as e:
+        logger.error(f"Failed to persist retry batch, it will be redelivered: {e}")
+        db.rollback()
+        ctx.history.clear()
+        ctx.dedup.rollback()
+
+        for tp, messages in batches.items():
+            consumer.seek(tp, messages[0].offset)
+
+    finally:
+        db.close()
+
+
+def main():
+    """Consume the retry tier topics and re-deliver notifications once their delay has passed"""
+    logger.info("Starting Kafka retry consumer...")
+
+    try:
+        initialize_firebase()
+    except Exception as e:
+        logger.error(f"Failed to initialize Firebase: {e}")
+        return
+
+    metrics.start_metrics_server(metrics.RETRY_WORKER_METRICS_PORT)
+
+    kafka_bootstrap_servers = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092").split(',')
+    topic = os.getenv("KAFKA_NOTIFICATIONS_TOPIC", "eta_notifications")
+    topics = retry_topics(topic)
+
+    consumer = KafkaConsumer(
+        *topics,
+        bootstrap_servers=kafka_bootstrap_servers,
+        auto_offset_reset='earliest',
+        enable_auto_commit=False,
+        max_poll_records=KAFKA_MAX_POLL_RECORDS,
+        group_id='notification-retry-group'
+    )
+
+    logger.info(f"Connected to Kafka, listening on retry topics: {topics}")
+
+    ctx = WorkerContext(
+        history=HistoryBuffer(),
+        retries=RetryScheduler(create_producer(kafka_bootstrap_servers), base_topic=topic),
+        dedup=DedupStore()
+    )
+    paused = {}
+
+    while True:
+        resume_due_partitions(consumer, paused)
+
+        batches = consumer.poll(timeout_ms=next_poll_timeout_ms(paused))
+        if not batches:
+            continue
+
+        process_retry_batch(consumer, batches, ctx, paused)
+
+
+if __name__ == "__main__":
+    main()